@@ -0,0 +1,548 @@
+"""Offline benchmark for resource_collector.py.
+
+Runs handler() end to end against a synthetic estate that is served from botocore event hooks instead of AWS,
+with optional per-call latency and throttling, and reports wall time, API calls, peak memory and output size.
+Results can be saved as a named baseline and later runs compared against it.
+
+    python3 benchmark.py --scenario medium --latency 0.05 --save-baseline before
+    python3 benchmark.py --scenario medium --latency 0.05 --baseline before
+"""
+import argparse
+import contextlib
+import copy
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from botocore.awsrequest import AWSResponse
+
+import resource_collector
+
+SCENARIOS = {
+    'small': {'ec2': 20, 'lambda': 20, 'sqs': 10, 'dynamodb': 5, 'rds': 2, 'efs': 2, 'ecs': 2, 'elbv2': 4,
+              'tgw': 1, 'dx': 4, 's3': 5, 'cloudfront': 2},
+    'medium': {'ec2': 200, 'lambda': 200, 'sqs': 100, 'dynamodb': 50, 'rds': 10, 'efs': 10, 'ecs': 10, 'elbv2': 40,
+               'tgw': 4, 'dx': 20, 's3': 50, 'cloudfront': 10},
+    'large': {'ec2': 2000, 'lambda': 1000, 'sqs': 500, 'dynamodb': 200, 'rds': 50, 'efs': 50, 'ecs': 40,
+              'elbv2': 200, 'tgw': 10, 'dx': 60, 's3': 200, 'cloudfront': 40}
+}
+
+ECS_SERVICES_PER_CLUSTER = 12
+TGW_ATTACHMENTS = 3
+TAG_KEY = 'iem'
+TAG_VALUE = 'benchmark'
+ACCOUNT = '123456789012'
+BASELINE_DIRECTORY = 'benchmark_baselines'
+REGIONS = ['eu-west-1', 'eu-north-1', 'eu-central-1', 'us-west-2', 'ap-southeast-2', 'eu-west-2', 'ap-northeast-1',
+           'ca-central-1']
+
+
+class StandInError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class SyntheticEstate:
+    """Deterministic set of tagged resources per region and the API responses that describe them."""
+
+    def __init__(self, regions, counts):
+        self.regions = regions
+        self.counts = counts
+        self.resources = {region: [] for region in regions}
+        self.instances = {}
+        self.volumes = {}
+        self.functions = {}
+        self.queues = {}
+        self.tables = {}
+        self.db_clusters = {}
+        self.file_systems = {}
+        self.ecs_clusters = {}
+        self.load_balancers = {}
+        self.target_groups = {}
+        self.tgw_attachments = {}
+        self.vifs = {}
+        self.connections = {}
+        self.buckets = {}
+        self.distributions = {}
+        for index, region in enumerate(regions):
+            self.build_region(index, region)
+        self.build_global()
+
+    def tag(self, region, arn):
+        self.resources[region].append({'ResourceARN': arn, 'Tags': [{'Key': TAG_KEY, 'Value': TAG_VALUE}]})
+
+    def build_region(self, index, region):
+        counts = self.counts
+        for i in range(counts.get('ec2', 0)):
+            instance_id = f'i-{index:02x}{i:015x}'
+            self.instances[(region, instance_id)] = {
+                'InstanceId': instance_id,
+                'InstanceType': 't3.micro' if i % 2 else 'm5.large',
+                'Placement': {'AvailabilityZone': f'{region}a'},
+                'CpuOptions': {'CoreCount': 1, 'ThreadsPerCore': 2}}
+            self.volumes[(region, instance_id)] = {
+                'VolumeId': f'vol-{index:02x}{i:015x}', 'VolumeType': 'gp3', 'Size': 8,
+                'Attachments': [{'InstanceId': instance_id, 'Device': '/dev/xvda'}]}
+            self.tag(region, f'arn:aws:ec2:{region}:{ACCOUNT}:instance/{instance_id}')
+
+        for i in range(counts.get('lambda', 0)):
+            name = f'function-{i}'
+            self.functions[(region, name)] = {
+                'FunctionName': name, 'FunctionArn': f'arn:aws:lambda:{region}:{ACCOUNT}:function:{name}',
+                'Runtime': 'python3.12', 'MemorySize': 128, 'Timeout': 3}
+            self.tag(region, f'arn:aws:lambda:{region}:{ACCOUNT}:function:{name}')
+
+        for i in range(counts.get('sqs', 0)):
+            name = f'queue-{i}'
+            self.queues[(region, name)] = f'https://sqs.{region}.amazonaws.com/{ACCOUNT}/{name}'
+            self.tag(region, f'arn:aws:sqs:{region}:{ACCOUNT}:{name}')
+
+        for i in range(counts.get('dynamodb', 0)):
+            name = f'table-{i}'
+            self.tables[(region, name)] = {
+                'TableName': name, 'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}}
+            self.tag(region, f'arn:aws:dynamodb:{region}:{ACCOUNT}:table/{name}')
+
+        for i in range(counts.get('rds', 0)):
+            name = f'cluster-{i}'
+            self.db_clusters[(region, name)] = {
+                'DBClusterIdentifier': name, 'MultiAZ': False, 'Engine': 'aurora-postgresql',
+                'EngineMode': 'provisioned', 'DBClusterMembers': [], 'Endpoint': f'{name}.{region}.rds',
+                'ReaderEndpoint': f'{name}-ro.{region}.rds', 'EngineVersion': '15.4', 'ReadReplicaIdentifiers': []}
+            self.tag(region, f'arn:aws:rds:{region}:{ACCOUNT}:cluster:{name}')
+
+        for i in range(counts.get('efs', 0)):
+            file_system_id = f'fs-{index:02x}{i:015x}'
+            self.file_systems[(region, file_system_id)] = {'FileSystemId': file_system_id, 'ThroughputMode': 'elastic'}
+            self.tag(region, f'arn:aws:elasticfilesystem:{region}:{ACCOUNT}:file-system/{file_system_id}')
+
+        for i in range(counts.get('ecs', 0)):
+            cluster_arn = f'arn:aws:ecs:{region}:{ACCOUNT}:cluster/cluster-{i}'
+            services = {}
+            for j in range(ECS_SERVICES_PER_CLUSTER):
+                service_arn = f'arn:aws:ecs:{region}:{ACCOUNT}:service/cluster-{i}/service-{j}'
+                # Pairs of services share a target group
+                target_group_arn = f'arn:aws:elasticloadbalancing:{region}:{ACCOUNT}:targetgroup/ecs-{i}-{j // 2}/{i:08x}{j // 2:08x}'
+                self.target_groups[(region, target_group_arn)] = {
+                    'TargetGroupArn': target_group_arn, 'LoadBalancerArns': [],
+                    'Targets': [f'i-{index:02x}{k:015x}' for k in range(2)]}
+                services[service_arn] = {
+                    'serviceArn': service_arn, 'serviceName': f'service-{j}',
+                    'launchType': 'EC2' if j % 2 == 0 else 'FARGATE',
+                    'loadBalancers': [{'targetGroupArn': target_group_arn}], 'events': [{'message': 'steady'}]}
+            self.ecs_clusters[(region, cluster_arn)] = {'cluster': {'clusterArn': cluster_arn, 'clusterName': f'cluster-{i}'},
+                                                        'services': services}
+            self.tag(region, cluster_arn)
+
+        for i in range(counts.get('elbv2', 0)):
+            load_balancer_arn = f'arn:aws:elasticloadbalancing:{region}:{ACCOUNT}:loadbalancer/app/alb-{i}/{index:08x}{i:08x}'
+            self.load_balancers[(region, load_balancer_arn)] = {
+                'LoadBalancerArn': load_balancer_arn, 'LoadBalancerName': f'alb-{i}', 'Type': 'application'}
+            for j in range(2):
+                target_group_arn = f'arn:aws:elasticloadbalancing:{region}:{ACCOUNT}:targetgroup/alb-{i}-{j}/{i:08x}{j:08x}'
+                self.target_groups[(region, target_group_arn)] = {
+                    'TargetGroupArn': target_group_arn, 'LoadBalancerArns': [load_balancer_arn], 'Targets': []}
+            self.tag(region, load_balancer_arn)
+
+        for i in range(counts.get('tgw', 0)):
+            tgw_id = f'tgw-{index:02x}{i:015x}'
+            self.tgw_attachments[(region, tgw_id)] = [
+                {'TransitGatewayId': tgw_id, 'TransitGatewayAttachmentId': f'tgw-attach-{index:02x}{i:07x}{j:08x}',
+                 'ResourceType': 'vpc'} for j in range(TGW_ATTACHMENTS)]
+            self.tag(region, f'arn:aws:ec2:{region}:{ACCOUNT}:transit-gateway/{tgw_id}')
+
+        for i in range(counts.get('dx', 0)):
+            vif_id = f'dxvif-{index:02x}{i:06x}'
+            connection_id = f'dxcon-{index:02x}{i // 2:06x}'
+            self.vifs[(region, vif_id)] = {'virtualInterfaceId': vif_id, 'connectionId': connection_id,
+                                           'virtualInterfaceType': 'private'}
+            self.connections[(region, connection_id)] = {'connectionId': connection_id, 'bandwidth': '1Gbps'}
+            self.tag(region, f'arn:aws:directconnect:{region}:{ACCOUNT}:dxvif/{vif_id}')
+
+    def build_global(self):
+        # Buckets are returned by the region they are located in, distributions by us-east-1 only
+        for i in range(self.counts.get('s3', 0)):
+            name = f'benchmark-bucket-{i}'
+            self.buckets[name] = self.regions[i % len(self.regions)]
+            self.tag(self.buckets[name], f'arn:aws:s3:::{name}')
+        if resource_collector.GLOBAL_REGION in self.resources:
+            for i in range(self.counts.get('cloudfront', 0)):
+                distribution_id = f'E{i:013X}'
+                self.distributions[distribution_id] = {
+                    'Id': distribution_id, 'ARN': f'arn:aws:cloudfront::{ACCOUNT}:distribution/{distribution_id}',
+                    'DomainName': f'{distribution_id.lower()}.cloudfront.net',
+                    'DistributionConfig': {'Aliases': {'Quantity': 0}, 'Origins': {'Quantity': 1, 'Items': []}}}
+                self.tag(resource_collector.GLOBAL_REGION, self.distributions[distribution_id]['ARN'])
+
+    def respond(self, service, operation, params, region):
+        handler = getattr(self, f'{service.replace("-", "_")}_{operation}', None)
+        if not handler:
+            raise StandInError('UnsupportedOperation', f'The benchmark estate does not serve {service} {operation}')
+        return handler(params, region)
+
+    @staticmethod
+    def filter_values(params, name):
+        return next((f['Values'] for f in params.get('Filters', []) if f['Name'] == name), [])
+
+    @staticmethod
+    def lookup(table, region, key, code):
+        if (region, key) not in table:
+            raise StandInError(code, f'{key} not found')
+        return table[(region, key)]
+
+    def resourcegroupstaggingapi_GetResources(self, params, region):
+        filters = params.get('ResourceTypeFilters')
+        resources = self.resources.get(region, [])
+        if filters:
+            def matches(arn):
+                arn = resource_collector.parse_arn(arn)
+                base_type = (arn.resource_type or '').split('/')[0]
+                return arn.service in filters or f'{arn.service}:{base_type}' in filters
+            resources = [resource for resource in resources if matches(resource['ResourceARN'])]
+        start = int(params.get('PaginationToken') or 0)
+        end = start + params.get('ResourcesPerPage', 100)
+        return {'ResourceTagMappingList': resources[start:end], 'PaginationToken': str(end) if end < len(resources) else ''}
+
+    def autoscaling_DescribeAutoScalingGroups(self, params, region):
+        return {'AutoScalingGroups': []}
+
+    def cloudwatch_ListMetrics(self, params, region):
+        metrics = [{'Namespace': 'Benchmark/App', 'MetricName': 'Requests', 'Dimensions': []},
+                   {'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization', 'Dimensions': []}]
+        for (instance_region, instance_id), _ in self.instances.items():
+            if instance_region == region and int(instance_id[-1], 16) % 2 == 0:
+                metrics.append({'Namespace': 'CWAgent', 'MetricName': 'mem_used_percent',
+                                'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]})
+        if params.get('Namespace'):
+            metrics = [metric for metric in metrics if metric['Namespace'] == params['Namespace']]
+        if params.get('MetricName'):
+            metrics = [metric for metric in metrics if metric['MetricName'] == params['MetricName']]
+        for wanted in params.get('Dimensions', []):
+            metrics = [metric for metric in metrics if any(
+                dimension['Name'] == wanted['Name'] and wanted.get('Value', dimension['Value']) == dimension['Value']
+                for dimension in metric['Dimensions'])]
+        return {'Metrics': metrics}
+
+    def ec2_DescribeInstances(self, params, region):
+        instance_ids = params.get('InstanceIds') or self.filter_values(params, 'instance-id')
+        return {'Reservations': [{'Instances': [self.instances[(region, instance_id)] for instance_id in instance_ids
+                                                if (region, instance_id) in self.instances]}]}
+
+    def ec2_DescribeVolumes(self, params, region):
+        instance_ids = self.filter_values(params, 'attachment.instance-id')
+        return {'Volumes': [self.volumes[(region, instance_id)] for instance_id in instance_ids
+                            if (region, instance_id) in self.volumes]}
+
+    def ec2_DescribeInstanceCreditSpecifications(self, params, region):
+        return {'InstanceCreditSpecifications': [{'InstanceId': instance_id, 'CpuCredits': 'unlimited'}
+                                                 for instance_id in params['InstanceIds']]}
+
+    def ec2_DescribeTransitGatewayAttachments(self, params, region):
+        return {'TransitGatewayAttachments': [attachment for tgw_id in self.filter_values(params, 'transit-gateway-id')
+                                              for attachment in self.tgw_attachments.get((region, tgw_id), [])]}
+
+    def lambda_ListFunctions(self, params, region):
+        return {'Functions': [function for (function_region, _), function in self.functions.items()
+                              if function_region == region]}
+
+    def lambda_GetFunction(self, params, region):
+        return {'Configuration': self.lookup(self.functions, region, params['FunctionName'], 'ResourceNotFoundException')}
+
+    def sqs_ListQueues(self, params, region):
+        return {'QueueUrls': [url for (queue_region, _), url in self.queues.items() if queue_region == region]}
+
+    def sqs_GetQueueUrl(self, params, region):
+        return {'QueueUrl': self.lookup(self.queues, region, params['QueueName'], 'QueueDoesNotExist')}
+
+    def sqs_GetQueueAttributes(self, params, region):
+        return {'Attributes': {'QueueArn': params['QueueUrl'], 'VisibilityTimeout': '30'}}
+
+    def dynamodb_DescribeTable(self, params, region):
+        return {'Table': self.lookup(self.tables, region, params['TableName'], 'ResourceNotFoundException')}
+
+    def rds_DescribeDBClusters(self, params, region):
+        if 'DBClusterIdentifier' in params:
+            return {'DBClusters': [self.lookup(self.db_clusters, region, params['DBClusterIdentifier'],
+                                               'DBClusterNotFoundFault')]}
+        return {'DBClusters': [cluster for (cluster_region, _), cluster in self.db_clusters.items()
+                               if cluster_region == region]}
+
+    def efs_DescribeFileSystems(self, params, region):
+        if 'FileSystemId' in params:
+            return {'FileSystems': [self.lookup(self.file_systems, region, params['FileSystemId'], 'FileSystemNotFound')]}
+        return {'FileSystems': [file_system for (file_system_region, _), file_system in self.file_systems.items()
+                                if file_system_region == region]}
+
+    def ecs_DescribeClusters(self, params, region):
+        return {'clusters': [self.lookup(self.ecs_clusters, region, cluster, 'ClusterNotFoundException')['cluster']
+                             for cluster in params['clusters']]}
+
+    def ecs_ListServices(self, params, region):
+        return {'serviceArns': list(self.lookup(self.ecs_clusters, region, params['cluster'],
+                                                'ClusterNotFoundException')['services'])}
+
+    def ecs_DescribeServices(self, params, region):
+        if len(params['services']) > 10:
+            raise StandInError('InvalidParameterException', 'At most 10 services can be described at once')
+        services = self.lookup(self.ecs_clusters, region, params['cluster'], 'ClusterNotFoundException')['services']
+        return {'services': [services[service] for service in params['services']]}
+
+    def elbv2_DescribeLoadBalancers(self, params, region):
+        return {'LoadBalancers': [self.lookup(self.load_balancers, region, arn, 'LoadBalancerNotFound')
+                                  for arn in params['LoadBalancerArns']]}
+
+    def elbv2_DescribeTargetGroups(self, params, region):
+        target_groups = [target_group for (target_group_region, _), target_group in self.target_groups.items()
+                         if target_group_region == region]
+        if 'LoadBalancerArn' in params:
+            target_groups = [target_group for target_group in target_groups
+                             if params['LoadBalancerArn'] in target_group['LoadBalancerArns']]
+        return {'TargetGroups': [{key: value for key, value in target_group.items() if key != 'Targets'}
+                                 for target_group in target_groups]}
+
+    def elbv2_DescribeTargetHealth(self, params, region):
+        target_group = self.lookup(self.target_groups, region, params['TargetGroupArn'], 'TargetGroupNotFound')
+        return {'TargetHealthDescriptions': [{'Target': {'Id': target}, 'TargetHealth': {'State': 'healthy'}}
+                                             for target in target_group['Targets']]}
+
+    def directconnect_DescribeVirtualInterfaces(self, params, region):
+        return {'virtualInterfaces': [vif for (vif_region, vif_id), vif in self.vifs.items() if vif_region == region
+                                      and params.get('virtualInterfaceId', vif_id) == vif_id]}
+
+    def directconnect_DescribeConnections(self, params, region):
+        return {'connections': [connection for (connection_region, connection_id), connection in self.connections.items()
+                                if connection_region == region and params.get('connectionId', connection_id) == connection_id]}
+
+    def s3_GetBucketEncryption(self, params, region):
+        return {'ServerSideEncryptionConfiguration': {'Rules': [
+            {'ApplyServerSideEncryptionByDefault': {'SSEAlgorithm': 'AES256'}, 'BucketKeyEnabled': False}]}}
+
+    def s3_GetBucketLocation(self, params, region):
+        location = self.buckets[params['Bucket']]
+        return {'LocationConstraint': None if location == 'us-east-1' else location}
+
+    def cloudfront_GetDistribution(self, params, region):
+        if params['Id'] not in self.distributions:
+            raise StandInError('NoSuchDistribution', params['Id'])
+        return {'Distribution': self.distributions[params['Id']]}
+
+    def sts_GetCallerIdentity(self, params, region):
+        return {'UserId': 'AIDABENCHMARK', 'Account': ACCOUNT, 'Arn': f'arn:aws:iam::{ACCOUNT}:user/benchmark'}
+
+
+class ServerLimit:
+    """Throttles like an AWS API would when a (service, region) is called faster than rate per second."""
+
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class StandIn:
+    """Answers every API call of the collector from a SyntheticEstate in before-call, before anything is sent.
+    As nothing reaches botocore's endpoint, the stand-in plays its part: it emits before-send and needs-retry to the
+    other pool hooks (rate scheduler, instrumentation) for every attempt and retries throttled attempts with
+    backoff like the standard retry mode does.
+    """
+
+    def __init__(self, estate, latency, throttle_rate, server_rate, max_attempts, backoff):
+        self.estate = estate
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.server_rate = server_rate
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.limits = {}
+        self.random = random.Random(42)
+
+    def install(self):
+        resource_collector.client_pool.register('before-parameter-build', self.before_parameter_build)
+        resource_collector.client_pool.register('before-call', self.before_call)
+
+    @staticmethod
+    def emit(event_name, service, region, account, **kwargs):
+        for hook_event_name, handler in resource_collector.client_pool.hooks:
+            if hook_event_name == event_name:
+                handler(service=service, region=region, account=account, **kwargs)
+
+    def before_parameter_build(self, params, context, **kwargs):
+        context['benchmark_params'] = dict(params)
+
+    def throttled(self, service, region):
+        with self.lock:
+            if self.server_rate and (service, region) not in self.limits:
+                self.limits[(service, region)] = ServerLimit(self.server_rate)
+            if self.throttle_rate and self.random.random() < self.throttle_rate:
+                return True
+        return bool(self.server_rate) and not self.limits[(service, region)].allow()
+
+    def before_call(self, service, region, account, model, context, **kwargs):
+        params = context.get('benchmark_params', {})
+        for attempt in range(self.max_attempts):
+            self.emit('before-send', service, region, account, request=None)
+            if self.latency:
+                time.sleep(self.latency)
+
+            if self.throttled(service, region):
+                http_response = AWSResponse('https://benchmark', 400, {}, None)
+                parsed = {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}
+                self.emit('needs-retry', service, region, account, response=(http_response, parsed),
+                          operation=model, attempts=attempt + 1, caught_exception=None)
+                if attempt + 1 < self.max_attempts:
+                    time.sleep(self.random.uniform(0, min(20, 2 ** attempt)) * self.backoff)
+                    continue
+            else:
+                try:
+                    http_response = AWSResponse('https://benchmark', 200, {}, None)
+                    parsed = copy.deepcopy(self.estate.respond(service, model.name, params, region))
+                except StandInError as error:
+                    http_response = AWSResponse('https://benchmark', 400, {}, None)
+                    parsed = {'Error': {'Code': error.code, 'Message': str(error)}}
+                self.emit('needs-retry', service, region, account, response=(http_response, parsed),
+                          operation=model, attempts=attempt + 1, caught_exception=None)
+
+            parsed['ResponseMetadata'] = {'HTTPStatusCode': http_response.status_code, 'RetryAttempts': attempt}
+            return http_response, parsed
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                     resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / scale, 1)
+
+
+def run(args, counts):
+    regions = REGIONS[:args.regions]
+    estate = SyntheticEstate(regions + [resource_collector.GLOBAL_REGION], counts)
+    collector = {'executor': args.executor} | json.loads(args.collector)
+
+    with tempfile.TemporaryDirectory(prefix='collector-benchmark-') as root:
+        os.makedirs(os.path.join(root, 'lib'))
+        os.makedirs(os.path.join(root, 'data'))
+        with open(os.path.join(root, 'lib', 'config.json'), "w", encoding="utf-8") as f:
+            f.write(json.dumps({'ResourceFile': 'resources.json', 'CustomNamespaceFile': 'custom_namespaces.json',
+                                'TagKey': TAG_KEY, 'TagValues': [TAG_VALUE], 'Regions': regions,
+                                'Collector': collector}))
+
+        working_directory = os.getcwd()
+        os.chdir(os.path.join(root, 'data'))
+        try:
+            settings = resource_collector.get_collector_settings({'Collector': collector})
+            resource_collector.install_hooks(settings)
+            StandIn(estate, args.latency, args.throttle_rate, args.server_rate, args.max_attempts, args.backoff).install()
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, 'w')):
+                resource_collector.handler()
+            wall = time.perf_counter() - start
+
+            output_file = os.path.join(root, 'data', 'resources.json')
+            with open(settings['runReportFile'], "r", encoding="utf-8") as rr:
+                report = json.load(rr)
+            calls_by_operation = {}
+            for call in report['Calls']:
+                operation = f'{call["Service"]}:{call["Operation"]}'
+                calls_by_operation[operation] = calls_by_operation.get(operation, 0) + call['Count']
+            return {'Scenario': args.scenario,
+                    'Counts': counts,
+                    'Regions': args.regions,
+                    'Latency': args.latency,
+                    'ThrottleRate': args.throttle_rate,
+                    'ServerRate': args.server_rate,
+                    'Collector': collector,
+                    'WallSeconds': round(wall, 3),
+                    'ApiCalls': sum(call['Count'] for call in report['Calls']),
+                    'Throttles': sum(call['Throttles'] for call in report['Calls']),
+                    'PeakMemoryMB': peak_memory_mb(),
+                    'OutputBytes': os.path.getsize(output_file),
+                    'Resources': report['Resources'],
+                    'CallsByOperation': dict(sorted(calls_by_operation.items(), key=lambda item: -item[1]))}
+        finally:
+            os.chdir(working_directory)
+
+
+def compare(result, baseline):
+    print(f'{"Metric":<16}{"Baseline":>14}{"Current":>14}{"Change":>10}')
+    for metric in ('WallSeconds', 'ApiCalls', 'Throttles', 'PeakMemoryMB', 'OutputBytes', 'Resources'):
+        before, after = baseline[metric], result[metric]
+        change = f'{(after - before) / before * 100:+.1f}%' if before else 'n/a'
+        print(f'{metric:<16}{before:>14}{after:>14}{change:>10}')
+    if baseline['Counts'] != result['Counts'] or baseline['Latency'] != result['Latency']:
+        print('Warning: the baseline was recorded with a different estate or latency')
+
+
+def parse_counts(scenario, overrides):
+    counts = dict(SCENARIOS[scenario])
+    for override in filter(None, (overrides or '').split(',')):
+        resource_type, count = override.split('=')
+        if resource_type not in counts:
+            raise SystemExit(f'Unknown resource type {resource_type}, use one of {", ".join(counts)}')
+        counts[resource_type] = int(count)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks resource_collector.py against a synthetic estate.')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='small', help='Estate size (default small)')
+    parser.add_argument('--counts', help='Per region overrides of the scenario, e.g. ec2=500,lambda=100')
+    parser.add_argument('--regions', type=int, default=2, choices=range(1, len(REGIONS) + 1),
+                        help='Configured regions (default 2)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Probability that an API call attempt is throttled')
+    parser.add_argument('--server-rate', type=float, default=0.0,
+                        help='Requests per second per service and region before the stand-in throttles (0 = no limit)')
+    parser.add_argument('--max-attempts', type=int, default=10, help='Attempts per call, as in get_config()')
+    parser.add_argument('--backoff', type=float, default=0.01,
+                        help='Scale of the standard mode retry backoff (1 = real backoff)')
+    parser.add_argument('--executor', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--collector', default='{}', help='JSON object of Collector settings for the run')
+    parser.add_argument('--save-baseline', metavar='NAME', help='Store the result as baseline NAME')
+    parser.add_argument('--baseline', metavar='NAME', help='Compare the result with baseline NAME')
+    parser.add_argument('--verbose', action='store_true', help='Show the collector output')
+    args = parser.parse_args()
+
+    if args.executor == 'process' and multiprocessing.get_start_method() != 'fork':
+        raise SystemExit('The process executor can only be benchmarked where workers are forked')
+    # The stand-in answers before requests are signed, the credentials are never used
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    baseline_directory = os.path.abspath(BASELINE_DIRECTORY)
+    result = run(args, parse_counts(args.scenario, args.counts))
+    print(json.dumps({key: value for key, value in result.items() if key != 'CallsByOperation'}, indent=4))
+    print(f'API calls by operation: {json.dumps(result["CallsByOperation"])}')
+
+    if args.baseline:
+        with open(os.path.join(baseline_directory, f'{args.baseline}.json'), "r", encoding="utf-8") as f:
+            compare(result, json.load(f))
+    if args.save_baseline:
+        os.makedirs(baseline_directory, exist_ok=True)
+        with open(os.path.join(baseline_directory, f'{args.save_baseline}.json'), "w", encoding="utf-8") as f:
+            f.write(json.dumps(result, indent=4))
+        print(f'Saved baseline {args.save_baseline}')
+
+
+if __name__ == '__main__':
+    main()
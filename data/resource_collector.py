@@ -1,250 +1,1081 @@
+import argparse
 import boto3
+import botocore.session
+import cProfile
+import copy
+import gzip
 import json
 import math
+import os
+import pstats
+import re
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial
+from botocore.awsrequest import AWSResponse
 from botocore.config import Config
+from botocore.credentials import AssumeRoleCredentialFetcher, DeferredRefreshableCredentials
+from botocore.exceptions import ClientError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COLLECTOR_DEFAULTS = {
+    'regionConcurrency': 4,
+    'executor': 'thread',
+    'decoratorConcurrency': 16,
+    'defaultServiceConcurrency': 4,
+    'serviceConcurrency': {
+        'directconnect': 1,
+        'ec2': 4,
+        'ecs': 2,
+        'elasticloadbalancing': 4,
+        'lambda': 8,
+        'sqs': 8,
+        's3': 8
+    },
+    'taggingConcurrency': 4,
+    'enrichmentConcurrency': 4,
+    'bulkPrefetchThreshold': 5,
+    'resourceTypeFilter': True,
+    'namespaceCacheFile': 'namespace_cache.json',
+    'namespaceCacheMaxAgeHours': 24,
+    'namespaceRecentlyActive': False,
+    'incremental': False,
+    'incrementalStateFile': 'collector_state.json',
+    'incrementalTtlMinutes': {
+        'default': 1440,
+        'autoscaling': 60,
+        'ec2': 60,
+        'ecs': 60,
+        'elasticloadbalancing': 60
+    },
+    'outputProjection': 'dashboard',
+    'outputFormat': 'json',
+    'outputGzip': False,
+    'workDirectory': 'collector_work',
+    'errorBudget': 10,
+    'accounts': [],
+    'organizationalUnit': '',
+    'assumeRoleName': 'CrossAccountAlarmAugmentationAssumeRole-{region}',
+    'runReportFile': 'collector_report.json',
+    'cassetteMode': 'off',
+    'cassetteFile': 'collector_cassette.ndjson.gz',
+    'rateScheduler': True,
+    'rateLimits': {
+        'default': 10,
+        'apigateway': 5,
+        'autoscaling': 20,
+        'cloudfront': 5,
+        'cloudwatch': 20,
+        'directconnect': 5,
+        'dynamodb': 10,
+        'ec2': 20,
+        'ecs': 20,
+        'elasticache': 10,
+        'elb': 10,
+        'elbv2': 10,
+        'lambda': 15,
+        'resourcegroupstaggingapi': 10,
+        's3': 50,
+        'sqs': 50
+    }
+}
+
+
+class ClientPool:
+    """Thread safe cache of boto3 clients.
+    Hands out one client per (service, region, account) for the whole run instead of building a new client,
+    with its service model, for every resource. boto3 clients are thread safe, sessions are not, so only
+    construction is done under the lock.
+    """
 
-singletons = []
-direct_connects = []
-direct_connect_vifs = []
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.clients = {}
+        self.hooks = []
+        self.hits = 0
+        self.misses = 0
+        self.construction_time = 0.0
+
+    def get(self, service, config, account='default', role_arn=None):
+        """Client of the run's own credentials, or of role_arn in account when it is given."""
+        key = (service, config.region_name, account)
+        with self.lock:
+            if key in self.clients:
+                self.hits += 1
+                return self.clients[key]
+
+            self.misses += 1
+            start = time.perf_counter()
+            session_key = role_arn or account
+            if session_key not in self.sessions:
+                self.sessions[session_key] = assumed_role_session(role_arn) if role_arn else boto3.session.Session()
+            client = self.sessions[session_key].client(service, config=config)
+            for event_name, handler in self.hooks:
+                self.attach(client, key, event_name, handler)
+            self.construction_time += time.perf_counter() - start
+            self.clients[key] = client
+            return client
+
+    @staticmethod
+    def attach(client, key, event_name, handler):
+        service, region, account = key
+        client.meta.events.register(event_name, partial(handler, service=service, region=region, account=account))
+
+    def register(self, event_name, handler):
+        """Registers a botocore event handler on every client of the pool, existing and future ones.
+        The handler is called with the botocore event arguments plus the service, region and account of the client.
+        """
+        with self.lock:
+            self.hooks.append((event_name, handler))
+            for key, client in self.clients.items():
+                self.attach(client, key, event_name, handler)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'Clients': len(self.clients),
+                    'Hits': self.hits,
+                    'Misses': self.misses,
+                    'HitRate': round(self.hits / requests, 3) if requests else 0.0,
+                    'ConstructionSeconds': round(self.construction_time, 3)}
+
+
+def assumed_role_session(role_arn):
+    """boto3 session with the credentials of role_arn, botocore assumes the role again before they expire."""
+    source_session = botocore.session.get_session()
+    fetcher = AssumeRoleCredentialFetcher(source_session.create_client, source_session.get_credentials(), role_arn,
+                                          extra_args={'RoleSessionName': 'ResourceCollector'})
+    role_session = botocore.session.get_session()
+    role_session._credentials = DeferredRefreshableCredentials(fetcher.fetch_credentials, 'assume-role')
+    return boto3.session.Session(botocore_session=role_session)
+
+
+client_pool = ClientPool()
+
+
+# Error codes AWS services use when a request was throttled
+THROTTLING_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+    'RequestThrottled', 'SlowDown', 'EC2ThrottledException', 'BandwidthLimitExceeded', 'LimitExceededException'
+}
+
+
+def is_throttled(http_response, parsed):
+    return http_response.status_code == 429 or parsed.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+class TokenBucket:
+    """Paces requests to rate per second, allowing bursts of up to one second worth of requests.
+    The rate is adaptive: it is halved when a request is throttled and grows back towards ceiling with every
+    request that is not.
+    """
 
+    def __init__(self, ceiling):
+        self.lock = threading.Lock()
+        self.ceiling = float(ceiling)
+        self.rate = self.ceiling
+        self.tokens = self.ceiling
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.throttles = 0
+        self.waited = 0.0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.requests += 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.throttles += 1
+            self.rate = max(self.ceiling / 32, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.ceiling, self.rate + self.ceiling / 50)
+
+
+class RateScheduler:
+    """Sends every API call of the collector through a token bucket per (service, region, account), AWS API limits
+    apply per account and region.
+    Buckets start at the configured rateLimits (requests per second, by boto3 service name) and adapt to throttling.
+    Each call only waits for the bucket of its own service, so a throttled service slows down without holding
+    back the others.
+    """
 
-def get_resources(tag_name, tag_values, config):
-    """Get resources from resource groups and tagging API.
-    Assembles resources in a list containing only ARN and tags
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limits = {}
+        self.buckets = {}
+
+    def configure(self, collector_settings):
+        self.limits = collector_settings['rateLimits']
+
+    def bucket(self, service, region, account):
+        with self.lock:
+            if (service, region, account) not in self.buckets:
+                self.buckets[(service, region, account)] = TokenBucket(self.limits.get(service, self.limits['default']))
+            return self.buckets[(service, region, account)]
+
+    def before_send(self, service, region, account, **kwargs):
+        # Also runs for every retry, so retries are paced as well
+        self.bucket(service, region, account).acquire()
+
+    def needs_retry(self, service, region, account, response=None, **kwargs):
+        if response is None:
+            return
+        http_response, parsed = response
+        if is_throttled(http_response, parsed):
+            self.bucket(service, region, account).throttled()
+        elif http_response.status_code < 400:
+            self.bucket(service, region, account).succeeded()
+
+    def stats(self):
+        """Buckets that throttled or waited, as 'service/region', with '/account' in multi-account mode."""
+        with self.lock:
+            stats = {}
+            for (service, region, account), bucket in self.buckets.items():
+                if bucket.throttles or bucket.waited:
+                    name = f'{service}/{region}' if account == 'default' else f'{service}/{region}/{account}'
+                    stats[name] = {'Requests': bucket.requests,
+                                   'Throttles': bucket.throttles,
+                                   'WaitSeconds': round(bucket.waited, 3),
+                                   'Rate': round(bucket.rate, 2)}
+            return stats
+
+
+rate_scheduler = RateScheduler()
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a sorted list."""
+    return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+
+
+class Instrumentation:
+    """Records every API call per (service, operation, region) through botocore event hooks, and the wall time of
+    every decorator per region. Worker processes drain() their records into their region results and handler()
+    merges them back, so report() covers the whole run in both executor modes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.decorators = {}
+
+    def call_record(self, key):
+        if key not in self.calls:
+            self.calls[key] = {'Latencies': [], 'Errors': 0, 'Retries': 0, 'Throttles': 0}
+        return self.calls[key]
+
+    def before_call(self, service, region, model, context, **kwargs):
+        context['collector_started'] = time.perf_counter()
+        context['collector_operation'] = model.name
+
+    def record_call(self, service, operation, region, context, retries, error):
+        elapsed = time.perf_counter() - context.get('collector_started', time.perf_counter())
+        with self.lock:
+            record = self.call_record((service, operation, region))
+            record['Latencies'].append(elapsed)
+            record['Retries'] += retries
+            if error:
+                record['Errors'] += 1
+
+    def after_call(self, service, region, model, context, http_response, parsed, **kwargs):
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        self.record_call(service, model.name, region, context, retries, http_response.status_code >= 400)
+
+    def after_call_error(self, service, region, context, exception, **kwargs):
+        """after-call-error only has the exception and the request context, the operation comes from before_call()."""
+        self.record_call(service, context.get('collector_operation'), region, context, 0, True)
+
+    def needs_retry(self, service, region, operation, response=None, **kwargs):
+        if response is not None and is_throttled(*response):
+            with self.lock:
+                self.call_record((service, operation.name, region))['Throttles'] += 1
+
+    def decorated(self, decorator, region, elapsed):
+        with self.lock:
+            record = self.decorators.setdefault((decorator, region), {'Count': 0, 'Seconds': 0.0})
+            record['Count'] += 1
+            record['Seconds'] += elapsed
+
+    def drain(self):
+        with self.lock:
+            records = {'Calls': self.calls, 'Decorators': self.decorators}
+            self.calls = {}
+            self.decorators = {}
+            return records
+
+    def merge(self, records):
+        with self.lock:
+            for key, calls in records['Calls'].items():
+                record = self.call_record(key)
+                record['Latencies'].extend(calls['Latencies'])
+                for counter in ('Errors', 'Retries', 'Throttles'):
+                    record[counter] += calls[counter]
+            for key, decorated in records['Decorators'].items():
+                record = self.decorators.setdefault(key, {'Count': 0, 'Seconds': 0.0})
+                record['Count'] += decorated['Count']
+                record['Seconds'] += decorated['Seconds']
+
+    def report(self):
+        with self.lock:
+            calls = []
+            for (service, operation, region), record in sorted(self.calls.items()):
+                latencies = sorted(record['Latencies'])
+                calls.append({'Service': service,
+                              'Operation': operation,
+                              'Region': region,
+                              'Count': len(latencies),
+                              'Errors': record['Errors'],
+                              'Retries': record['Retries'],
+                              'Throttles': record['Throttles'],
+                              'TotalSeconds': round(sum(latencies), 3),
+                              'P50Ms': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+                              'P90Ms': round(percentile(latencies, 90) * 1000, 1) if latencies else None,
+                              'P99Ms': round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+                              'MaxMs': round(latencies[-1] * 1000, 1) if latencies else None})
+            decorators = [{'Decorator': decorator, 'Region': region, 'Count': record['Count'],
+                           'Seconds': round(record['Seconds'], 3)}
+                          for (decorator, region), record in sorted(self.decorators.items(),
+                                                                    key=lambda item: -item[1]['Seconds'])]
+            return {'Calls': calls, 'Decorators': decorators}
+
+
+instrumentation = Instrumentation()
+
+
+def encode_cassette_value(value):
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    return str(value)
+
+
+def decode_cassette_value(value):
+    if len(value) == 1 and '$datetime' in value:
+        return datetime.fromisoformat(value['$datetime'])
+    return value
+
+
+class Cassette:
+    """Records every API response of a run to a gzip compressed NDJSON file, or serves them back without network.
+    Calls are keyed by (service, region, account, operation, parameters). A key that was called more than once is
+    replayed in recording order, repeating its last response. Calls that are not on the cassette fail with a
+    CassetteMiss client error, so the collector handles them like any other failed call.
     """
-    resourcetaggingapi = boto3.client('resourcegroupstaggingapi', config=config)
-    resources = []
 
-    tags = len(tag_values)
-    if tags > 5:
-        tags_processed = 0
-        while tags_processed < tags:
-            incremental_tag_values = tag_values[tags_processed:tags_processed+5]
-            resources = get_resources_from_api(resourcetaggingapi, resources, tag_name, incremental_tag_values)
-            tags_processed += 5
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None
+        self.file = None
+        self.recorded = []
+        self.responses = {}
+        self.replayed = 0
+        self.misses = 0
+
+    def configure(self, collector_settings):
+        self.mode = collector_settings['cassetteMode']
+        self.file = collector_settings['cassetteFile']
+        if self.mode == 'replay':
+            with gzip.open(self.file, 'rt', encoding='utf-8') as cassette:
+                for line in cassette:
+                    interaction = json.loads(line, object_hook=decode_cassette_value)
+                    self.responses.setdefault(interaction['Key'], deque()).append(
+                        (interaction['Status'], interaction['Response']))
+            print(f'Replaying {sum(len(responses) for responses in self.responses.values())} API calls from {self.file}')
+
+    @staticmethod
+    def call_key(service, region, account, operation, params):
+        return json.dumps([service, region, account, operation, params], sort_keys=True, default=encode_cassette_value)
+
+    def before_parameter_build(self, service, region, account, params, model, context, **kwargs):
+        context['cassette_key'] = self.call_key(service, region, account, model.name, params)
+
+    def before_call(self, model, context, **kwargs):
+        key = context['cassette_key']
+        with self.lock:
+            responses = self.responses.get(key)
+            if responses:
+                status, response = responses.popleft() if len(responses) > 1 else responses[0]
+                self.replayed += 1
+            else:
+                self.misses += 1
+                print(f'Cassette miss: {key}')
+                status, response = 400, {'Error': {'Code': 'CassetteMiss', 'Message': 'Call is not on the cassette'}}
+        response = copy.deepcopy(response)
+        response['ResponseMetadata'] = {'HTTPStatusCode': status, 'RetryAttempts': 0}
+        return AWSResponse('', status, {}, None), response
+
+    def after_call(self, http_response, parsed, context, **kwargs):
+        # Serialised right away, decorators modify the parsed responses they get
+        response = {key: value for key, value in parsed.items() if key != 'ResponseMetadata'}
+        line = json.dumps({'Key': context['cassette_key'], 'Status': http_response.status_code, 'Response': response},
+                          default=encode_cassette_value)
+        with self.lock:
+            self.recorded.append(line)
+
+    def drain(self):
+        with self.lock:
+            recorded = self.recorded
+            self.recorded = []
+            return recorded
+
+    def merge(self, recorded):
+        with self.lock:
+            self.recorded.extend(recorded)
+
+    def save(self):
+        with self.lock:
+            with gzip.open(self.file, 'wt', encoding='utf-8') as cassette:
+                for line in self.recorded:
+                    cassette.write(line + '\n')
+            print(f'Recorded {len(self.recorded)} API calls to {self.file}')
+
+    def stats(self):
+        with self.lock:
+            return {'Mode': self.mode, 'Recorded': len(self.recorded), 'Replayed': self.replayed, 'Misses': self.misses}
+
+
+cassette = Cassette()
+hooks_installed = None  # Process ID of the process whose client pool has the hooks
+
+
+def install_hooks(collector_settings):
+    """Attaches the botocore event handlers to the client pool of this process, once per process.
+    Also runs as initializer of the region workers, forked workers inherit the hooks of their parent.
+    """
+    global hooks_installed
+    if hooks_installed == os.getpid():
+        return
+    if hooks_installed:
+        # Forked worker: the hooks are in place, but the calls and recordings of the parent, e.g. sts and
+        # organizations of get_accounts(), were copied too and would be drained back to it a second time
+        instrumentation.drain()
+        cassette.drain()
+        hooks_installed = os.getpid()
+        return
+    hooks_installed = os.getpid()
+    client_pool.register('before-call', instrumentation.before_call)
+    client_pool.register('after-call', instrumentation.after_call)
+    client_pool.register('after-call-error', instrumentation.after_call_error)
+    client_pool.register('needs-retry', instrumentation.needs_retry)
+    if collector_settings['cassetteMode'] in ('record', 'replay'):
+        cassette.configure(collector_settings)
+        client_pool.register('before-parameter-build', cassette.before_parameter_build)
+    if collector_settings['cassetteMode'] == 'record':
+        client_pool.register('after-call', cassette.after_call)
+    if collector_settings['cassetteMode'] == 'replay':
+        # Registered after instrumentation, the first before-call handler that returns a response ends the call
+        client_pool.register('before-call', cassette.before_call)
+    elif collector_settings['rateScheduler']:
+        rate_scheduler.configure(collector_settings)
+        client_pool.register('before-send', rate_scheduler.before_send)
+        client_pool.register('needs-retry', rate_scheduler.needs_retry)
+
+
+class MetricIndex:
+    """Region wide index of available CloudWatch metrics by dimension value.
+    Replaces one list_metrics probe per resource with a single paginated sweep per
+    (namespace, dimension, metric name) that is done the first time it is needed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sweeps = set()
+        self.metrics = {}
+
+    def sweep(self, context, namespace, dimension_name, metric_name=None):
+        cw = context.client('cloudwatch')
+        arguments = {'Namespace': namespace, 'Dimensions': [{'Name': dimension_name}]}
+        if metric_name:
+            arguments['MetricName'] = metric_name
+
+        count = 0
+        for page in cw.get_paginator('list_metrics').paginate(**arguments):
+            for metric in page['Metrics']:
+                for dimension in metric['Dimensions']:
+                    if dimension['Name'] == dimension_name:
+                        key = (namespace, metric_name, dimension_name, dimension['Value'])
+                        self.metrics.setdefault(key, []).append(metric)
+                count += 1
+        print(f'Indexed {count} {namespace} metrics by {dimension_name} in {context.region}')
+
+    def get(self, context, namespace, dimension_name, dimension_value, metric_name=None):
+        """Returns the list_metrics records of namespace that have dimension_name=dimension_value."""
+        sweep = (namespace, metric_name, dimension_name)
+        with self.lock:
+            if sweep not in self.sweeps:
+                self.sweep(context, namespace, dimension_name, metric_name)
+                self.sweeps.add(sweep)
+        return self.metrics.get((namespace, metric_name, dimension_name, dimension_value), [])
+
+
+class ErrorBudgetExceeded(Exception):
+    pass
+
+
+class RegionContext:
+    """Per-region collection state.
+    Every region is collected by its own worker, so anything that used to live in module globals
+    (Direct Connect grouping etc.) is kept here and merged by handler() once all regions are done.
+    In multi-account mode a context is per account and region, clients use role_arn unless it is None.
+    """
+
+    def __init__(self, region, collector_settings, account=None, role_arn=None):
+        self.region = region
+        self.account = account
+        self.role_arn = role_arn
+        self.collector_settings = collector_settings
+        self.config = get_config(region)
+        self.prefetched = {}
+        self.children = {}
+        self.used_replication_groups = set()
+        self.index_lock = threading.Lock()
+        self.indexes = {}
+        self.dx_vifs = {}
+        self.dx_connections = {}
+        self.dx_vif_resources = {}
+        self.ec2_prefetched = set()
+        self.ec2_instances = {}
+        self.ec2_volumes = {}
+        self.ec2_credit_specs = {}
+        self.metric_index = MetricIndex()
+        self.failure_lock = threading.Lock()
+        self.failures = []
+
+    def client(self, service):
+        if self.account:
+            return client_pool.get(service, self.config, self.account, self.role_arn)
+        return client_pool.get(service, self.config)
+
+    def annotate(self, resource):
+        """Adds the account to resources collected in multi-account mode."""
+        if self.account:
+            resource['Account'] = self.account
+        return resource
+
+    def failed(self, resource, decorator, error):
+        """Records a resource whose decorator raised, the region is aborted once more than errorBudget failed."""
+        print(f'Could not decorate {resource["ResourceARN"]}, leaving it out: {error!r}')
+        with self.failure_lock:
+            self.failures.append({'ResourceARN': resource['ResourceARN'],
+                                  'Decorator': decorator,
+                                  'Error': repr(error)})
+            if len(self.failures) > int(self.collector_settings['errorBudget']):
+                raise ErrorBudgetExceeded(f'{len(self.failures)} resources failed in {self.region}, errorBudget is '
+                                          f'{self.collector_settings["errorBudget"]}')
+
+    def index(self, name, build):
+        """Returns the region wide index name, calling build() to create it the first time it is needed."""
+        with self.index_lock:
+            if name not in self.indexes:
+                self.indexes[name] = build()
+            return self.indexes[name]
+
+
+# Fields the dashboard widget sets read, per resource type ("service:resourceType" or "service").
+# True keeps a value as it is, a nested dict projects a dict (or every dict in a list) to its keys.
+# ResourceARN, Tags and Account are always kept, types without a schema are written whole.
+OUTPUT_PROJECTIONS = {
+    'ec2:instance': {
+        'Instance': {
+            'InstanceId': True,
+            'InstanceType': True,
+            'Placement': {'AvailabilityZone': True},
+            'CpuOptions': True
+        },
+        'Volumes': {'VolumeId': True, 'AvailabilityZone': True, 'VolumeType': True, 'Iops': True},
+        'CPUCreditSpecs': True,
+        'CWAgent': True
+    },
+    'ecs:cluster': {
+        'cluster': {'clusterArn': True, 'clusterName': True, 'runningTasksCount': True, 'activeServicesCount': True},
+        'services': {'serviceArn': True, 'serviceName': True, 'launchType': True, 'runningCount': True, 'instances': True}
+    },
+    'elasticloadbalancing:loadbalancer': {
+        'Extras': {'LoadBalancerName': True, 'Type': True, 'AvailabilityZones': True},
+        'TargetGroups': {'TargetGroupArn': True, 'TargetGroupName': True}
+    },
+    'ec2:transit-gateway': {
+        'attachments': {'TransitGatewayAttachmentId': True, 'ResourceType': True, 'ResourceId': True}
+    },
+    'cloudfront:distribution': {
+        'Id': True,
+        'ARN': True,
+        'DomainName': True,
+        'Aliases': {'Quantity': True},
+        'Origins': {'Quantity': True}
+    },
+    'network-firewall:firewall': {
+        'Firewall': {'FirewallName': True, 'FirewallArn': True, 'FirewallPolicyArn': True, 'VpcId': True},
+        'FirewallStatus': {'Status': True, 'SyncStates': True},
+        'Metrics': True
+    },
+    'lambda:function': {
+        'Configuration': {'FunctionName': True, 'FunctionArn': True, 'Runtime': True, 'MemorySize': True}
+    }
+}
+
+
+def projection_schema(arn):
+    """Schema for a resource type, e.g. 'ec2:instance', falling back to the schema of its service."""
+    base_type = (arn.resource_type or '').split('/')[0]
+    return OUTPUT_PROJECTIONS.get(f'{arn.service}:{base_type}', OUTPUT_PROJECTIONS.get(arn.service))
+
+
+def project(value, schema):
+    if schema is True:
+        return value
+    if isinstance(value, list):
+        return [project(item, schema) for item in value]
+    if isinstance(value, dict):
+        return {key: project(item, schema[key]) for key, item in value.items() if key in schema}
+    return value
+
+
+def project_resource(resource, collector_settings):
+    """Drops the parts of API responses the dashboards never read, unless outputProjection is 'full'."""
+    if collector_settings['outputProjection'] == 'full':
+        return resource
+    schema = projection_schema(parse_arn(resource['ResourceARN']))
+    if not schema:
+        return resource
+    return project(resource, schema | {'ResourceARN': True, 'Tags': True, 'Account': True})
+
+
+def dumps(resource):
+    """Single line JSON, using orjson when it is installed."""
+    if orjson:
+        return orjson.dumps(resource, default=str, option=orjson.OPT_PASSTHROUGH_DATETIME).decode('utf-8')
+    return json.dumps(resource, default=str)
+
+
+class ResourceWriter:
+    """Writes resources to a file one at a time instead of serialising the whole list at the end.
+    Formats are 'json' (indented array, the default), 'compact' (single line array) and 'ndjson'
+    (one resource per line), optionally gzip compressed.
+    """
+
+    @staticmethod
+    def line(resource, output_format):
+        """Serialises a resource once, in the layout of output_format, as a single line of valid JSON.
+        For 'json' that is the json.dumps(indent=4) layout with tabs for its newlines. json.dumps escapes every
+        control character inside strings, so the only tabs are the former newlines, which are JSON whitespace.
+        """
+        if output_format == 'json':
+            return json.dumps(resource, indent=4, default=str).replace('\n', '\t')
+        return dumps(resource)
+
+    def __init__(self, path, output_format='json', gzip_output=False):
+        self.output_format = output_format
+        self.count = 0
+        if gzip_output:
+            self.file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, resource):
+        self.write_line(self.line(resource, self.output_format))
+
+    def write_line(self, line):
+        """Writes a resource that is already serialised by line() for the format of this writer."""
+        if self.output_format == 'ndjson':
+            self.file.write(line + '\n')
+        elif self.output_format == 'compact':
+            self.file.write(('[' if self.count == 0 else ',') + line)
+        else:
+            # Same layout as json.dumps(resources, indent=4)
+            self.file.write(('[\n    ' if self.count == 0 else ',\n    ') + line.replace('\t', '\n    '))
+        self.count += 1
+
+    def close(self):
+        if self.output_format == 'compact':
+            self.file.write(']' if self.count else '[]')
+        elif self.output_format != 'ndjson':
+            self.file.write('\n]' if self.count else '[]')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_resources(path, output_format='json', gzip_output=False):
+    """Reads a resource file written by ResourceWriter."""
+    if gzip_output:
+        f = gzip.open(path, 'rt', encoding='utf-8')
     else:
-        resources = get_resources_from_api(resourcetaggingapi, resources, tag_name, tag_values)
-    resources.extend(autoscaling_retriever(tag_name, tag_values, config))
-    return resources
+        f = open(path, 'r', encoding='utf-8')
+    with f:
+        if output_format == 'ndjson':
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
 
 
-def get_resources_from_api(resourcetaggingapi, resources, tag_name, tag_values):
-    response = resourcetaggingapi.get_resources(
-        TagFilters=[
-            {
-                'Key': tag_name,
-                'Values': tag_values
-            },
-        ],
-        ResourcesPerPage=40
-    )
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
 
-    resources.extend(response['ResourceTagMappingList'])
-    while response['PaginationToken'] != '':
-        print('Got the pagination token')
-        response = resourcetaggingapi.get_resources(
-            PaginationToken=response['PaginationToken'],
+def get_resources(tag_name, tag_values, context, collector_settings, global_only=False):
+    """Get resources from resource groups and tagging API.
+    Assembles resources in a list containing only ARN and tags
+    Tag values are fetched in chunks of 5 concurrently, resources are de-duplicated by ARN
+    (autoscaling groups can be returned by both APIs) keeping the first occurrence.
+    With global_only only GLOBAL_RESOURCE_TYPES are fetched, filtered by in_global_plan().
+    """
+    tag_chunks = list(chunks(tag_values, 5))
+    resource_type_filters = GLOBAL_RESOURCE_TYPES if global_only else get_resource_type_filters(collector_settings)
+    workers = max(1, int(collector_settings['taggingConcurrency']))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(get_resources_from_api, context, tag_name, tag_chunk,
+                                   resource_type_filters) for tag_chunk in tag_chunks]
+        if not global_only:
+            futures.extend(executor.submit(get_asgs_from_api, context, tag_name, tag_chunk) for tag_chunk in tag_chunks)
+
+        resources = {}
+        for future in futures:
+            for resource in future.result():
+                resources.setdefault(resource['ResourceARN'], resource)
+
+    if global_only:
+        return [resource for resource in resources.values() if in_global_plan(parse_arn(resource['ResourceARN']))]
+    return list(resources.values())
+
+
+def get_resources_from_api(context, tag_name, tag_values, resource_type_filters=None):
+    resourcetaggingapi = context.client('resourcegroupstaggingapi')
+    resources = []
+    pages = 0
+    start = time.perf_counter()
+    arguments = {}
+    if resource_type_filters:
+        arguments['ResourceTypeFilters'] = resource_type_filters
+    for page in resourcetaggingapi.get_paginator('get_resources').paginate(
             TagFilters=[
                 {
                     'Key': tag_name,
                     'Values': tag_values
                 },
             ],
-            ResourcesPerPage=40
-        )
-        resources.extend(response['ResourceTagMappingList'])
+            PaginationConfig={'PageSize': 100},
+            **arguments):
+        resources.extend(page['ResourceTagMappingList'])
+        pages += 1
 
+    print(f'Fetched {len(resources)} tagged resources for {tag_values} in {context.region} '
+          f'({pages} pages, {time.perf_counter() - start:.2f}s)')
     return resources
 
 
-def autoscaling_retriever(tag_name, tag_values, config):
-    resources = []
-    tags = len(tag_values)
-    if tags > 5:
-        tags_processed = 0
-        while tags_processed < tags:
-            incremental_tag_values = tag_values[tags_processed:tags_processed+5]
-            resources.extend(get_asgs_from_api(tag_name, incremental_tag_values, config))
-            tags_processed += 5
-    else:
-        resources.extend(get_asgs_from_api(tag_name, tag_values, config))
-
-    return resources
-
-
-def get_asgs_from_api(tag_name, tag_values, config):
+def get_asgs_from_api(context, tag_name, tag_values):
     """Autoscaling is not supported by resource groups and tagging api
     This is
     :return:
     """
-    asg = boto3.client('autoscaling', config=config)
+    asg = context.client('autoscaling')
     resources = []
-    response = asg.describe_auto_scaling_groups(
-        Filters=[
-            {
-                'Name': 'tag:'+tag_name,
-                'Values': tag_values
-            }
-        ],
-        MaxRecords=10
-    )
-    resources.extend(response['AutoScalingGroups'])
-    try:
-        while response['NextToken']:
-            response = asg.describe_auto_scaling_groups(
-                NextToken=response['NextToken'],
-                Filters=[
-                    {
-                        'Name': 'tag:'+tag_name,
-                        'Values': tag_values
-                    }
-                ],
-                MaxRecords=10
-            )
-            resources.extend(response['AutoScalingGroups'])
-    except:
-        print(f'Done fetching autoscaling groups')
+    pages = 0
+    start = time.perf_counter()
+    for page in asg.get_paginator('describe_auto_scaling_groups').paginate(
+            Filters=[
+                {
+                    'Name': 'tag:'+tag_name,
+                    'Values': tag_values
+                }
+            ],
+            PaginationConfig={'PageSize': 100}):
+        resources.extend(page['AutoScalingGroups'])
+        pages += 1
 
     for resource in resources:
         resource['ResourceARN'] = resource['AutoScalingGroupARN']
 
+    print(f'Fetched {len(resources)} autoscaling groups for {tag_values} in {context.region} '
+          f'({pages} pages, {time.perf_counter() - start:.2f}s)')
     return resources
 
 
-def cw_custom_namespace_retriever(config):
+def is_custom_namespace(namespace):
+    return not namespace.startswith('AWS/') and not namespace.startswith('CWAgent')
+
+
+def discover_custom_namespaces(cw, namespaces, known, now, **list_metrics_arguments):
+    """Streams list_metrics pages and records every custom namespace with the time it was seen."""
+    for page in cw.get_paginator('list_metrics').paginate(**list_metrics_arguments):
+        for record in page['Metrics']:
+            namespace = record['Namespace']
+            if is_custom_namespace(namespace):
+                if namespace not in namespaces and namespace not in known:
+                    print(f'Found custom namespace {namespace}')
+                namespaces[namespace] = now
+
+
+def cw_custom_namespace_retriever(context, collector_settings, cached=None):
     """Retrieving all custom namespaces
+    A full list_metrics sweep is only done when there is no fresh cache entry for the region. Otherwise recently
+    active metrics are listed to pick up new namespaces and cached namespaces that were not seen are confirmed
+    with a single list_metrics call each. Returns the namespaces and the updated cache entry.
     """
-    cw = boto3.client('cloudwatch', config=config)
-    resources = []
-    response = cw.list_metrics()
-    for record in response['Metrics']:
-        if not record['Namespace'].startswith('AWS/') and not record['Namespace'].startswith('CWAgent') and record['Namespace'] not in resources:
-            resources.append(record['Namespace'])
-            print(resources)
+    cw = context.client('cloudwatch')
+    now = datetime.now(timezone.utc)
+    max_age = timedelta(hours=collector_settings['namespaceCacheMaxAgeHours'])
+    namespaces = {}
+
+    if cached and now - datetime.fromisoformat(cached['Refreshed']) < max_age:
+        print(f'Extending cached custom namespaces in {context.region}')
+        discover_custom_namespaces(cw, namespaces, cached['Namespaces'], now.isoformat(), RecentlyActive='PT3H')
+        for namespace in cached['Namespaces']:
+            if namespace in namespaces:
+                continue
+            if cw.list_metrics(Namespace=namespace)['Metrics']:
+                namespaces[namespace] = now.isoformat()
+            else:
+                print(f'Custom namespace {namespace} no longer has metrics')
+        refreshed = cached['Refreshed']
+    else:
+        arguments = {}
+        if collector_settings['namespaceRecentlyActive']:
+            arguments['RecentlyActive'] = 'PT3H'
+        discover_custom_namespaces(cw, namespaces, {}, now.isoformat(), **arguments)
+        refreshed = now.isoformat()
+
+    print(f'Done fetching cloudwatch namespaces in {context.region}')
+    return sorted(namespaces), {'Refreshed': refreshed, 'Namespaces': dict(sorted(namespaces.items()))}
+
 
+def load_namespace_cache(collector_settings):
+    if collector_settings['cassetteMode'] != 'off':
+        # The calls of a cassette run may not depend on local files, a cached discovery would not replay
+        return {}
     try:
-        while response['NextToken']:
-            response = cw.list_metrics(
-                NextToken = response['NextToken']
-            )
-            for record in response['Metrics']:
-                if not record['Namespace'].startswith('AWS/') and not record['Namespace'].startswith('CWAgent') and record['Namespace'] not in resources:
-                    resources.append(record['Namespace'])
-                    print(resources)
-    except:
-        print(f'Done fetching cloudwatch namespaces')
-    return resources
+        with open(collector_settings['namespaceCacheFile'], "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+Arn = namedtuple('Arn', ['partition', 'service', 'region', 'account', 'resource_type', 'resource_id'])
+
+# (service, resource type) -> decorator, filled by @decorates. A resource type of None matches the whole service.
+DECORATORS = {}
+
+# (service, resource type) -> region wide bulk fetch, filled by @prefetches
+PREFETCHERS = {}
+
+# (service, resource type) -> fetch of the children of all parents of a region, filled by @fans_in
+FAN_INS = {}
+
+# Tagging API ResourceTypeFilters ("service[:resourceType]") of the registered decorators
+DECORATOR_TYPE_FILTERS = set()
+
+# Region of the global services, collected with a 'global' plan when it is not one of the configured regions
+GLOBAL_REGION = 'us-east-1'
+
+# Types fetched by a 'global' plan. Their ARNs have no region, collect_global() decorates them once per run.
+# WAFv2 has global (CloudFront) and regional scopes in one type, in_global_plan() keeps only the global scope.
+GLOBAL_RESOURCE_TYPES = [
+    'cloudfront:distribution',
+    's3',
+    'wafv2'
+]
+
+def in_global_plan(arn):
+    """Whether a resource of GLOBAL_RESOURCE_TYPES belongs to a 'global' plan. Global scope WAFv2 resources are in
+    GLOBAL_REGION, like arn:aws:wafv2:us-east-1:123456789012:global/webacl/name/id.
+    """
+    return arn.service != 'wafv2' or arn.resource_type == 'global'
+
+
+# Types the dashboards use straight from the tagging API without a decorator
+PASSTHROUGH_RESOURCE_TYPES = [
+    'wafv2'
+]
+
+
+@lru_cache(maxsize=65536)
+def parse_arn(arn):
+    """Splits an ARN into its parts. The resource part can be 'type/id', 'type:id', 'id' or, for API Gateway,
+    a path like '/restapis/id/stages/name' (type 'restapis/stages', id 'name').
+    Load balancer types carry their flavour, e.g. 'loadbalancer/app' for an ALB and 'loadbalancer' for a classic ELB.
+    """
+    partition, service, region, account, resource = arn.split(':', 5)[1:]
+    if resource.startswith('/'):
+        path = resource.strip('/').split('/')
+        return Arn(partition, service, region, account, '/'.join(path[0::2]), path[-1])
+
+    type_and_id = re.match(r'([^/:]*)[/:](.*)', resource)
+    if not type_and_id:
+        return Arn(partition, service, region, account, None, resource)
+
+    resource_type, resource_id = type_and_id.groups()
+    if service == 'elasticloadbalancing' and resource_id.split('/')[0] in ('app', 'net', 'gwy'):
+        resource_type = f'{resource_type}/{resource_id.split("/")[0]}'
+        resource_id = resource_id.split('/', 1)[1]
+    return Arn(partition, service, region, account, resource_type, resource_id.split('/')[-1])
+
+
+def decorates(service, resource_type=None, type_filter=None, tagging=True):
+    """Registers a decorator for a (service, resource type).
+    type_filter overrides the tagging API ResourceTypeFilter, tagging=False for types that do not come from
+    the tagging API.
+    """
+    def register(decorator):
+        DECORATORS[(service, resource_type)] = decorator
+        if tagging:
+            DECORATOR_TYPE_FILTERS.add(type_filter or (f'{service}:{resource_type}' if resource_type else service))
+        return decorator
+    return register
+
+
+def prefetches(service, resource_type=None):
+    """Registers a region wide bulk fetch for a (service, resource type), returning a dict of resource ID -> item."""
+    def register(fetch):
+        PREFETCHERS[(service, resource_type)] = fetch
+        return fetch
+    return register
+
+
+def fans_in(service, resource_type=None):
+    """Registers a fetch of the child resources of all (service, resource type) parents of a region at once.
+    The fetch gets the parent ARNs and returns a dict of parent ARN -> list of children.
+    """
+    def register(fetch):
+        FAN_INS[(service, resource_type)] = fetch
+        return fetch
+    return register
+
+
+def children(context, resource_arn):
+    """The children fan_in() fetched for a parent, or None when the decorator has to fetch them itself."""
+    arn = parse_arn(resource_arn)
+    return context.children.get((arn.service, arn.resource_type), {}).get(resource_arn)
+
+
+def prefetched(context, arn):
+    """The item prefetch_region() fetched for arn, or None when the decorator has to describe it itself."""
+    return context.prefetched.get((arn.service, arn.resource_type), {}).get(arn.resource_id)
+
+
+def find_decorator(arn):
+    return DECORATORS.get((arn.service, arn.resource_type), DECORATORS.get((arn.service, None)))
+
 
+def type_name(arn):
+    return f'{arn.service}:{arn.resource_type}' if arn.resource_type else arn.service
 
-def router(resource, config):
-    arn = resource['ResourceARN']
-    if ':apigateway:' in arn and '/restapis/' in arn and 'stages' not in arn:
-        resource = apigw1_decorator(resource, config)
-    elif ':apigateway:' in arn and '/apis/' in arn and 'stages' not in arn:
-        resource = apigw2_decorator(resource, config)
-    elif ':appsync:' in arn:
-        resource = appsync_decorator(resource, config)
-    elif ':rds:' in arn and ':cluster:' in arn:
-        resource = aurora_decorator(resource, config)
-    elif ':autoscaling:' in arn and ':autoScalingGroup:' in arn:
-        resource = autoscaling_decorator(resource, config)
-    elif ':capacity-reservation/' in arn:
-        resource = odcr_decorator(resource, config)
-    elif ':dynamodb:' in arn and ':table/' in arn:
-        resource = dynamodb_decorator(resource, config)
-    elif ':ec2:' in arn and ':instance/' in arn:
-        resource = ec2_decorator(resource, config)
-    elif 'lambda' in arn and 'function' in arn:
-        resource = lambda_decorator(resource, config)
-    elif 'elasticloadbalancing' in arn and '/net/' not in arn and '/app/' not in arn and ':targetgroup/' not in arn:
-        resource = elb1_decorator(resource, config)
-    elif 'elasticloadbalancing' in arn and ( '/net/' in arn or '/app/' in arn ) and ':targetgroup/' not in arn and ':listener/' not in arn:
-        resource = elb2_decorator(resource, config)
-    elif ':ecs:' in arn and ':cluster/' in arn:
-        resource = ecs_decorator(resource, config)
-    elif ':natgateway/' in arn and ':ec2:' in arn:
-        resource = natgw_decorator(resource, config)
-    elif ':transit-gateway/' in arn and ':ec2:' in arn:
-        resource = tgw_decorator(resource, config)
-    elif ':sqs:' in arn:
-        resource = sqs_decorator(resource, config)
-    elif 'arn:aws:s3:' in arn:
-        resource = s3_decorator(resource, config)
-    elif ':sns:' in arn:
-        resource = sns_decorator(resource, config)
-    elif ':cloudfront:' in arn and ':distribution/' in arn:
-        resource = cloudfront_decorator(resource, config)
-    elif ':elasticache:' in arn:
-        resource = elasticache_decorator(resource, config)
-    elif ':mediapackage:' in arn and ':channels/' in arn:
-        resource = mediapackage_decorator(resource, config)
-    elif ':medialive:' in arn and ':channel:' in arn:
-        resource = medialive_decorator(resource, config)
-    elif ':elasticfilesystem:' in arn:
-        resource = efs_decorator(resource, config)
-    elif 'arn:aws:elasticbeanstalk:' in arn:
-        resource = beanstalk_decorator(resource, config)
-    elif 'arn:aws:network-firewall:' in arn and ':firewall/' in arn:
-        resource = network_firewall_decorator(resource, config)
-    elif 'arn:aws:directconnect:' in arn and ':dxvif/' in arn:
-        resource = direct_connect_handler(resource, config)
-    elif 'arn:aws:networkmonitor:' in arn and ':monitor/' in arn:
-        resource = network_monitor_decorator(resource, config)
+
+def get_resource_type_filters(collector_settings):
+    """Resource types pushed down to the tagging API, or None to fetch every tagged resource."""
+    if not collector_settings['resourceTypeFilter']:
+        return None
+    return sorted(DECORATOR_TYPE_FILTERS) + PASSTHROUGH_RESOURCE_TYPES
+
+
+def router(resource, context):
+    arn = parse_arn(resource['ResourceARN'])
+    decorator = find_decorator(arn)
+    if decorator:
+        start = time.perf_counter()
+        try:
+            resource = decorator(resource, context, arn)
+        except Exception as e:
+            context.failed(resource, decorator.__name__, e)
+            return None
+        instrumentation.decorated(decorator.__name__, context.region, time.perf_counter() - start)
     return resource
 
 
-def direct_connect_handler(resource, config):
+def prefetch_direct_connect(context):
+    """Describes every VIF and connection of the region once and indexes them by ID."""
+    client = context.client('directconnect')
+    context.dx_vifs = {vif['virtualInterfaceId']: vif
+                       for vif in client.describe_virtual_interfaces()['virtualInterfaces']}
+    context.dx_connections = {connection['connectionId']: connection
+                              for connection in client.describe_connections()['connections']}
+    print(f'{context.region}: prefetched {len(context.dx_vifs)} Direct Connect VIFs and '
+          f'{len(context.dx_connections)} connections')
+
+
+@decorates('directconnect', 'dxvif')
+def direct_connect_handler(resource, context, arn):
+    """Attaches the VIF description, group_direct_connects() later puts the VIF under its connection."""
     print(f'This resource is DX VIF {resource["ResourceARN"]}')
-    vif_id = resource['ResourceARN'].split('/')[1:][0]
-    client = boto3.client('directconnect', config=config)
-    response = client.describe_virtual_interfaces(
-        virtualInterfaceId=vif_id
-    )
-    resource['vif'] = response['virtualInterfaces'][0]
-    connection_id = resource['vif']['connectionId']
-
-    if direct_connects:
-        for direct_connect in direct_connects:
-            if connection_id not in direct_connect['connectionId']:
-                handle_new_direct_connect_connection(resource, config, connection_id)
-                break
-            else:
-                direct_connect['VIFs'].append(resource)
-                break
-    else:
-        handle_new_direct_connect_connection(resource, config, connection_id)
+    vif_id = arn.resource_id
+    if vif_id not in context.dx_vifs:
+        response = context.client('directconnect').describe_virtual_interfaces(
+            virtualInterfaceId=vif_id
+        )
+        context.dx_vifs[vif_id] = response['virtualInterfaces'][0]
+    resource['vif'] = context.dx_vifs[vif_id]
+    context.dx_vif_resources[resource['ResourceARN']] = resource
+
 
+def get_direct_connect_connection(context, connection_id):
+    if connection_id not in context.dx_connections:
+        response = context.client('directconnect').describe_connections(
+            connectionId=connection_id
+        )
+        context.dx_connections[connection_id] = response['connections'][0] if response['connections'] else None
+    return context.dx_connections[connection_id]
 
 
-def handle_new_direct_connect_connection(resource, config, connection_id):
-    client = boto3.client('directconnect', config=config)
-    region = resource['ResourceARN'].split(':')[3]
-    account_id = resource['ResourceARN'].split(':')[4]
-    response = client.describe_connections(
-        connectionId=resource['vif']['connectionId']
-    )
-    if response['connections']:
-        top_resource = {'DirectConnect': response['connections'][0],
-                        'ResourceARN': f'arn:aws:directconnect:{region}:{account_id}:dxcon/{connection_id}',
-                        'connectionId': connection_id,
-                        'VIFs': [resource]}
-        direct_connects.append(top_resource)
-    else:  # Some VIFs do not attach to real connection, handle them separately
-        append = True
-        for vif in direct_connect_vifs:
-            if vif['ResourceARN'] == resource['ResourceARN']:
-                append = False
-                break
-
-        if append:
-            direct_connect_vifs.append(resource)
-
-
-def apigw1_decorator(resource, config):
+def group_direct_connects(resources, context):
+    """Groups the decorated VIFs under their connection in one pass over resources, keeping the tagging order.
+    Returns the connections (each with its VIFs) and the VIFs that do not attach to a real connection.
+    """
+    direct_connects = {}
+    direct_connect_vifs = {}
+    for resource in resources:
+        vif = context.dx_vif_resources.get(resource['ResourceARN'])
+        if not vif:
+            continue
+        connection_id = vif['vif']['connectionId']
+        if connection_id in direct_connects:
+            direct_connects[connection_id]['VIFs'].append(vif)
+            continue
+
+        connection = get_direct_connect_connection(context, connection_id)
+        if connection:
+            arn = parse_arn(vif['ResourceARN'])
+            direct_connects[connection_id] = {
+                'DirectConnect': connection,
+                'ResourceARN': f'arn:{arn.partition}:directconnect:{arn.region}:{arn.account}:dxcon/{connection_id}',
+                'connectionId': connection_id,
+                'VIFs': [vif]}
+        else:  # Some VIFs do not attach to real connection, handle them separately
+            direct_connect_vifs.setdefault(vif['ResourceARN'], vif)
+    return list(direct_connects.values()), list(direct_connect_vifs.values())
+
+
+@decorates('apigateway', 'restapis', type_filter='apigateway')
+def apigw1_decorator(resource, context, arn):
     print(f'This resource is API Gateway 1 {resource["ResourceARN"]}')
-    apiid = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    apigw = boto3.client('apigateway', config=config)
-    response = apigw.get_rest_api(
+    apiid = arn.resource_id
+    apigw = context.client('apigateway')
+    response = prefetched(context, arn) or apigw.get_rest_api(
         restApiId=apiid
     )
     response2 = apigw.get_stages(
@@ -257,11 +1088,12 @@ def apigw1_decorator(resource, config):
     return resource
 
 
-def apigw2_decorator(resource, config):
+@decorates('apigateway', 'apis', type_filter='apigateway')
+def apigw2_decorator(resource, context, arn):
     print(f'This resource is API Gateway 2 {resource["ResourceARN"]}')
-    apiid = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/')) - 1]
-    apigw = boto3.client('apigatewayv2', config=config)
-    response = apigw.get_api(
+    apiid = arn.resource_id
+    apigw = context.client('apigatewayv2')
+    response = prefetched(context, arn) or apigw.get_api(
         ApiId=apiid
     )
     resource['name'] = response['Name']
@@ -272,62 +1104,71 @@ def apigw2_decorator(resource, config):
     return resource
 
 
-def appsync_decorator(resource, config):
+@decorates('appsync')
+def appsync_decorator(resource, context, arn):
     print(f'This resource is AppSync {resource["ResourceARN"]}')
-    apiid = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/')) - 1]
-    appsync = boto3.client('appsync', config=config)
-    response = appsync.get_graphql_api(
-        apiId=apiid
-    )
-    resource['name'] = response['graphqlApi']['name']
-    resource['apiId'] = response['graphqlApi']['apiId']
-    resource['xrayEnabled'] = response['graphqlApi']['xrayEnabled']
-    resource['realtimeUri'] = response['graphqlApi']['uris']['REALTIME']
-    resource['graphqlUri'] = response['graphqlApi']['uris']['GRAPHQL']
+    apiid = arn.resource_id
+    api = prefetched(context, arn)
+    if not api:
+        appsync = context.client('appsync')
+        api = appsync.get_graphql_api(
+            apiId=apiid
+        )['graphqlApi']
+    resource['name'] = api['name']
+    resource['apiId'] = api['apiId']
+    resource['xrayEnabled'] = api['xrayEnabled']
+    resource['realtimeUri'] = api['uris']['REALTIME']
+    resource['graphqlUri'] = api['uris']['GRAPHQL']
 
     return resource
 
 
-def aurora_decorator(resource, config):
+@decorates('rds', 'cluster')
+def aurora_decorator(resource, context, arn):
     print(f'This resource is Aurora {resource["ResourceARN"]}')
-    clusterid = resource['ResourceARN'].split(':')[len(resource['ResourceARN'].split(':')) - 1]
-    rds = boto3.client('rds', config=config)
+    clusterid = arn.resource_id
     try:
-        response = rds.describe_db_clusters(
-            DBClusterIdentifier=clusterid
-        )
-        resource['MultiAZ'] = response['DBClusters'][0]['MultiAZ']
-        resource['Engine'] = response['DBClusters'][0]['Engine']
-        resource['EngineMode'] = response['DBClusters'][0]['EngineMode']
-        resource['DBClusterMembers'] = response['DBClusters'][0]['DBClusterMembers']
-        resource['Endpoint'] = response['DBClusters'][0]['Endpoint']
-        resource['ReaderEndpoint'] = response['DBClusters'][0]['ReaderEndpoint']
-        resource['EngineVersion'] = response['DBClusters'][0]['EngineVersion']
-        resource['ReadReplicaIdentifiers'] = response['DBClusters'][0]['ReadReplicaIdentifiers']
-        resource['DBClusterInstanceClass'] = resource['DBClusters'][0]['DBClusterInstanceClass']
-        resource['StorageType'] = response['DBClusters'][0]['StorageType']
-        resource['Iops'] = response['DBClusters'][0]['Iops']
-        resource['PerformanceInsightsEnabled'] = response['DBClusters'][0]['PerformanceInsightsEnabled']
+        cluster = prefetched(context, arn)
+        if not cluster:
+            rds = context.client('rds')
+            cluster = rds.describe_db_clusters(
+                DBClusterIdentifier=clusterid
+            )['DBClusters'][0]
+        resource['MultiAZ'] = cluster['MultiAZ']
+        resource['Engine'] = cluster['Engine']
+        resource['EngineMode'] = cluster['EngineMode']
+        resource['DBClusterMembers'] = cluster['DBClusterMembers']
+        resource['Endpoint'] = cluster['Endpoint']
+        resource['ReaderEndpoint'] = cluster['ReaderEndpoint']
+        resource['EngineVersion'] = cluster['EngineVersion']
+        resource['ReadReplicaIdentifiers'] = cluster['ReadReplicaIdentifiers']
+        resource['DBClusterInstanceClass'] = cluster['DBClusterInstanceClass']
+        resource['StorageType'] = cluster['StorageType']
+        resource['Iops'] = cluster['Iops']
+        resource['PerformanceInsightsEnabled'] = cluster['PerformanceInsightsEnabled']
     except:
         print('Just aurora-resource')
 
     return resource
 
 
-def autoscaling_decorator(resource, config):
+@decorates('autoscaling', 'autoScalingGroup', tagging=False)
+def autoscaling_decorator(resource, context, arn):
     print(f'This resource is Autoscaling Group {resource["ResourceARN"]}')
     return resource
 
 
-def beanstalk_decorator(resource, config):
+@decorates('elasticbeanstalk')
+def beanstalk_decorator(resource, context, arn):
     return resource
 
 
-def cloudfront_decorator(resource, config):
+@decorates('cloudfront', 'distribution')
+def cloudfront_decorator(resource, context, arn):
     print(f'This resource is CloudFront distribution')
-    client = boto3.client('cloudfront', config=config)
+    client = context.client('cloudfront')
     response = client.get_distribution(
-        Id = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
+        Id = arn.resource_id
     )
     resource['Id'] = response['Distribution']['Id']
     resource['ARN'] = response['Distribution']['ARN']
@@ -337,49 +1178,49 @@ def cloudfront_decorator(resource, config):
     return resource
 
 
-def mediapackage_decorator(resource, config):
+@decorates('mediapackage', 'channels')
+def mediapackage_decorator(resource, context, arn):
     print(f'this resource is Mediapackage channel')
-    arn = resource['ResourceARN']
-    client = boto3.client('mediapackage', config=config)
-    response = client.list_channels(
-        MaxResults=40,
-    
-    )
-    for i in range(len(response['Channels'])):
-        if (arn == response['Channels'][i]['Arn']):
-            resource['Id'] = response['Channels'][i]['Id']
-            resource['ARN'] = response['Channels'][i]['Arn']
-            response2 = client.describe_channel(Id = response['Channels'][i]['Id'])
-            origin_endpoint = client.list_origin_endpoints(
-                ChannelId = response['Channels'][i]['Id']
-                )
-            resource ['IngestEndpoint'] = response2['HlsIngest']['IngestEndpoints']
-            resource['OriginEndpoint'] = origin_endpoint['OriginEndpoints']
+    client = context.client('mediapackage')
+    channels = context.index('mediapackage:channels',
+                             lambda: paginate_index(client, 'list_channels', 'Channels', 'Arn'))
+    channel = channels.get(resource['ResourceARN'])
+    if channel:
+        resource['Id'] = channel['Id']
+        resource['ARN'] = channel['Arn']
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            response2 = executor.submit(client.describe_channel, Id=channel['Id'])
+            origin_endpoints = executor.submit(
+                lambda: [endpoint
+                         for page in client.get_paginator('list_origin_endpoints').paginate(ChannelId=channel['Id'])
+                         for endpoint in page['OriginEndpoints']])
+            resource['IngestEndpoint'] = response2.result()['HlsIngest']['IngestEndpoints']
+            resource['OriginEndpoint'] = origin_endpoints.result()
     return resource
 
 
-def medialive_decorator(resource, config):
+@decorates('medialive', 'channel')
+def medialive_decorator(resource, context, arn):
     print(f'this resource is Medialive channel')
-    arn = resource['ResourceARN']
-    client = boto3.client('medialive', config=config)
-    response = client.list_channels(
-        MaxResults=40,
-    )
-    for i in range(len(response['Channels'])):
-        if (arn == response['Channels'][i]['Arn']):
-            resource['ARN'] = response['Channels'][i]['Arn']
-            resource['id'] = response['Channels'][i]['Id']
-            response2 = client.describe_channel(
-                ChannelId = response['Channels'][i]['Id']
-                )
-            resource['Pipeline'] = response2['PipelineDetails']
+    client = context.client('medialive')
+    channels = context.index('medialive:channels',
+                             lambda: paginate_index(client, 'list_channels', 'Channels', 'Arn'))
+    channel = channels.get(resource['ResourceARN'])
+    if channel:
+        resource['ARN'] = channel['Arn']
+        resource['id'] = channel['Id']
+        response2 = client.describe_channel(
+            ChannelId = channel['Id']
+            )
+        resource['Pipeline'] = response2['PipelineDetails']
     return resource
 
 
-def network_monitor_decorator(resource, config):
+@decorates('networkmonitor', 'monitor')
+def network_monitor_decorator(resource, context, arn):
     print(f'This resource is Network Monitor {resource["ResourceARN"]}')
-    monitor_name = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    client = boto3.client('networkmonitor', config=config)
+    monitor_name = arn.resource_id
+    client = context.client('networkmonitor')
 
     result = client.get_monitor(
         monitorName=monitor_name
@@ -389,15 +1230,17 @@ def network_monitor_decorator(resource, config):
     return resource
 
 
-def odcr_decorator(resource, config):
+@decorates('ec2', 'capacity-reservation')
+def odcr_decorator(resource, context, arn):
     print(f'This resource is ODCR {resource["ResourceARN"]}')
     return resource
 
 
-def dynamodb_decorator(resource, config):
+@decorates('dynamodb', 'table')
+def dynamodb_decorator(resource, context, arn):
     print(f'This resource is DynamoDB {resource["ResourceARN"]}')
-    tablename = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    ddb = boto3.client('dynamodb', config=config)
+    tablename = arn.resource_id
+    ddb = context.client('dynamodb')
     response = ddb.describe_table(
         TableName=tablename
     )
@@ -415,119 +1258,137 @@ def dynamodb_decorator(resource, config):
     return resource
 
 
-def efs_decorator(resource, config):
+@decorates('elasticfilesystem', 'file-system')
+def efs_decorator(resource, context, arn):
     print(f'This resource is EFS {resource["ResourceARN"]}')
-    fs_id = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    efs = boto3.client('efs', config=config)
-    response = efs.describe_file_systems(
-        FileSystemId=fs_id
-    )
-    
-    resource['ThroughputMode'] = response['FileSystems'][0]['ThroughputMode']
+    fs_id = arn.resource_id
+    file_system = prefetched(context, arn)
+    if not file_system:
+        efs = context.client('efs')
+        file_system = efs.describe_file_systems(
+            FileSystemId=fs_id
+        )['FileSystems'][0]
+
+    resource['ThroughputMode'] = file_system['ThroughputMode']
     return resource
 
 
-def ec2_decorator(resource, config):
-    print(f'This resource is EC2 {resource["ResourceARN"]}')
-    instanceid = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    ec2 = boto3.client('ec2', config=config)
-
-    volumes = []
-
-    volume_paginator = ec2.get_paginator('describe_volumes')
-    volume_iterator = volume_paginator.paginate(
-        Filters=[
-            {
-                'Name': 'attachment.instance-id',
-                'Values': [
-                    instanceid,
-                ]
-            },
-        ]
-    )
+def is_burstable(instance_type):
+    return 't2' in instance_type or 't3' in instance_type or 't4' in instance_type
 
-    for page in volume_iterator:
-        for volume in page['Volumes']:
-            volumes.append(volume)
 
-    resource['Volumes'] = volumes
+def prefetch_ec2_instances(instance_ids, context):
+    """Fetches instances, attached volumes and burstable credit specifications for many instances at once.
+    Uses multi-value filters (max 200 values per filter) instead of four calls per instance and stores the
+    results in the region context indexes that ec2_decorator() reads from.
+    """
+    ec2 = context.client('ec2')
+    instance_ids = [instance_id for instance_id in dict.fromkeys(instance_ids) if instance_id not in context.ec2_prefetched]
+    if not instance_ids:
+        return
+    print(f'Prefetching {len(instance_ids)} EC2 instances in {context.region}')
+
+    for id_chunk in chunks(instance_ids, 200):
+        for page in ec2.get_paginator('describe_instances').paginate(
+                Filters=[{'Name': 'instance-id', 'Values': id_chunk}]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    context.ec2_instances[instance['InstanceId']] = instance
+
+        chunk_ids = set(id_chunk)
+        for page in ec2.get_paginator('describe_volumes').paginate(
+                Filters=[{'Name': 'attachment.instance-id', 'Values': id_chunk}]):
+            for volume in page['Volumes']:
+                for attachment in volume['Attachments']:
+                    if attachment['InstanceId'] in chunk_ids:
+                        context.ec2_volumes.setdefault(attachment['InstanceId'], []).append(volume)
+
+    burstable_ids = [instance_id for instance_id in instance_ids
+                     if instance_id in context.ec2_instances and is_burstable(context.ec2_instances[instance_id]['InstanceType'])]
+    for id_chunk in chunks(burstable_ids, 100):
+        for page in ec2.get_paginator('describe_instance_credit_specifications').paginate(InstanceIds=id_chunk):
+            for credit_spec in page['InstanceCreditSpecifications']:
+                context.ec2_credit_specs[credit_spec['InstanceId']] = credit_spec
+
+    context.ec2_prefetched.update(instance_ids)
+
+
+@decorates('ec2', 'instance')
+def ec2_decorator(resource, context, arn):
+    print(f'This resource is EC2 {resource["ResourceARN"]}')
+    instanceid = arn.resource_id
+    if instanceid not in context.ec2_prefetched:
+        prefetch_ec2_instances([instanceid], context)
 
-    response = ec2.describe_instances(
-        Filters=[
-            {
-               'Name': 'instance-id',
-               'Values': [
-                   instanceid
-               ]
-            }
-        ]
-    )
-    resource['Instance'] = response['Reservations'][0]['Instances'][0]
+    resource['Volumes'] = context.ec2_volumes.get(instanceid, [])
+    resource['Instance'] = context.ec2_instances[instanceid]
     instance_type = resource['Instance']['InstanceType']
 
-    if 't2' in instance_type or 't3' in instance_type or 't4' in instance_type:
-        response = ec2.describe_instance_credit_specifications(
-            InstanceIds=[instanceid]
-        )
-        resource['CPUCreditSpecs'] = response['InstanceCreditSpecifications'][0]
-
-    cw = boto3.client('cloudwatch', config=config)
-    results = cw.get_paginator('list_metrics')
-    for response in results.paginate(
-            MetricName='mem_used_percent',
-            Namespace='CWAgent',
-            Dimensions=[
-                {'Name': 'InstanceId', 'Value': instanceid}
-            ], ):
-        if response['Metrics']:
-            print(f'Instance {instanceid} has CWAgent')
-            resource['CWAgent'] = 'True'
-        else:
-            print(f'Instance {instanceid} does not have CWAgent')
-            resource['CWAgent'] = 'False'
+    if is_burstable(instance_type):
+        resource['CPUCreditSpecs'] = context.ec2_credit_specs[instanceid]
+
+    if context.metric_index.get(context, 'CWAgent', 'InstanceId', instanceid, metric_name='mem_used_percent'):
+        print(f'Instance {instanceid} has CWAgent')
+        resource['CWAgent'] = 'True'
+    else:
+        print(f'Instance {instanceid} does not have CWAgent')
+        resource['CWAgent'] = 'False'
 
     return resource
 
 
-def elasticache_decorator(resource, config):
+@decorates('elasticache')
+def elasticache_decorator(resource, context, arn):
     print(f'This resource is Elasticache {resource["ResourceARN"]}')
-    if ':cluster:' in resource['ResourceARN']:
-        clusterid = resource['ResourceARN'].split(':')[len(resource['ResourceARN'].split(':'))-1]
-        client = boto3.client('elasticache', config=config)
-        response = client.describe_cache_clusters(
+    if arn.resource_type == 'cluster':
+        clusterid = arn.resource_id
+        client = context.client('elasticache')
+        resource['ClusterInfo'] = prefetched(context, arn) or client.describe_cache_clusters(
             CacheClusterId=clusterid
-        )
-        resource['ClusterInfo'] = response['CacheClusters'][0]
+        )['CacheClusters'][0]
         if 'redis' in resource['ClusterInfo']['Engine']:
             replication_group = resource['ClusterInfo']['ReplicationGroupId']
-            response2 = client.describe_replication_groups(
-                                   ReplicationGroupId=replication_group
-                               )
-            resource['ReplicationGroup'] = response2['ReplicationGroups'][0]
-            try:
-                with open(f'../data/{resource["ClusterInfo"]["CacheClusterId"]}_replicationgroup.json', "w", encoding="utf-8") as cn:
-                    cn.write(json.dumps(resource['ReplicationGroup'], indent=4, default=str))
-            finally:
-                cn.close()
+            replication_groups = context.index('elasticache:replication-groups', lambda: paginate_index(
+                client, 'describe_replication_groups', 'ReplicationGroups', 'ReplicationGroupId'))
+            if replication_group not in replication_groups:
+                response2 = client.describe_replication_groups(
+                                       ReplicationGroupId=replication_group
+                                   )
+                replication_groups[replication_group] = response2['ReplicationGroups'][0]
+            # All member clusters share the one group record, write_replication_groups() writes it once
+            resource['ReplicationGroup'] = replication_groups[replication_group]
+            context.used_replication_groups.add(replication_group)
 
     return resource
 
 
-def lambda_decorator(resource, config):
+def write_replication_groups(context):
+    """Writes every replication group used by a decorated cluster to its own file, once per group."""
+    replication_groups = context.indexes.get('elasticache:replication-groups', {})
+    for replication_group in sorted(context.used_replication_groups):
+        with open(f'../data/{replication_group}_replicationgroup.json', "w", encoding="utf-8") as cn:
+            cn.write(json.dumps(replication_groups[replication_group], indent=4, default=str))
+
+
+@decorates('lambda', 'function')
+def lambda_decorator(resource, context, arn):
     print(f'This resource is Lambda {resource["ResourceARN"]}')
-    functionname = resource['ResourceARN'].split(':')[len(resource['ResourceARN'].split(':')) - 1]
-    lambdaclient = boto3.client('lambda', config=config)
-    response = lambdaclient.get_function(
-        FunctionName=functionname
-    )
-    resource['Configuration'] = response['Configuration']
+    functionname = arn.resource_id
+    configuration = prefetched(context, arn)
+    if not configuration:
+        lambdaclient = context.client('lambda')
+        configuration = lambdaclient.get_function(
+            FunctionName=functionname
+        )['Configuration']
+    resource['Configuration'] = configuration
     return resource
 
 
-def elb1_decorator(resource, config):
+@decorates('elasticloadbalancing', 'loadbalancer')
+def elb1_decorator(resource, context, arn):
     print(f'This resource is ELBv1 {resource["ResourceARN"]}')
-    elbname = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    elb = boto3.client('elb', config=config)
+    elbname = arn.resource_id
+    elb = context.client('elb')
     response = elb.describe_load_balancers(
        LoadBalancerNames=[
            elbname
@@ -537,9 +1398,11 @@ def elb1_decorator(resource, config):
     return resource
 
 
-def elb2_decorator(resource, config):
+@decorates('elasticloadbalancing', 'loadbalancer/app', type_filter='elasticloadbalancing:loadbalancer')
+@decorates('elasticloadbalancing', 'loadbalancer/net', type_filter='elasticloadbalancing:loadbalancer')
+def elb2_decorator(resource, context, arn):
     print(f'This resource is ELBv2 {resource["ResourceARN"]}')
-    elb = boto3.client('elbv2', config=config)
+    elb = context.client('elbv2')
     response = elb.describe_load_balancers(
         LoadBalancerArns=[
             resource['ResourceARN']
@@ -547,23 +1410,49 @@ def elb2_decorator(resource, config):
     )
     resource['Extras'] = response['LoadBalancers'][0]
 
-    target_groups = []
-
-    tg_paginator = elb.get_paginator('describe_target_groups')
-    tg_page_iterator = tg_paginator.paginate(
-        LoadBalancerArn=resource['ResourceARN']
-    )
+    target_groups = children(context, resource['ResourceARN'])
+    if target_groups is None:
+        target_groups = []
+        tg_paginator = elb.get_paginator('describe_target_groups')
+        tg_page_iterator = tg_paginator.paginate(
+            LoadBalancerArn=resource['ResourceARN']
+        )
 
-    for tg_page in tg_page_iterator:
-        target_groups.extend(tg_page['TargetGroups'])
+        for tg_page in tg_page_iterator:
+            target_groups.extend(tg_page['TargetGroups'])
 
     resource['TargetGroups'] = target_groups
     return resource
 
 
-def ecs_decorator(resource, config):
+def describe_ecs_services(ecs, cluster, service_arns, workers):
+    """describe_services takes at most 10 services per call, the batches are described concurrently."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        responses = executor.map(lambda batch: ecs.describe_services(cluster=cluster, services=batch),
+                                 chunks(service_arns, 10))
+        services = [service for response in responses for service in response['services']]
+    for service in services:
+        del service['events']
+    return services
+
+
+def get_target_instances(elb, target_groups, workers):
+    """Index of target group ARN -> registered target IDs, one describe_target_health per unique target group."""
+    def describe(target_group):
+        response = elb.describe_target_health(
+            TargetGroupArn=target_group
+        )
+        return target_group, [target['Target']['Id'] for target in response['TargetHealthDescriptions']]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(executor.map(describe, target_groups))
+
+
+@decorates('ecs', 'cluster')
+def ecs_decorator(resource, context, arn):
     print(f'This resource is ECS {resource["ResourceARN"]}')
-    ecs = boto3.client('ecs', config=config)
+    workers = max(1, int(context.collector_settings['enrichmentConcurrency']))
+    ecs = context.client('ecs')
     response = ecs.describe_clusters(
         clusters=[
             resource['ResourceARN']
@@ -571,53 +1460,50 @@ def ecs_decorator(resource, config):
     )
     resource['cluster'] = response['clusters'][0]
 
-    services = []
+    service_arns = []
     sv_paginator = ecs.get_paginator('list_services')
     sv_page_iterator = sv_paginator.paginate(
         cluster=resource['ResourceARN']
     )
     for sv_page in sv_page_iterator:
-        services.extend(sv_page['serviceArns'])
+        service_arns.extend(sv_page['serviceArns'])
+    services = describe_ecs_services(ecs, resource['ResourceARN'], service_arns, workers)
 
-    response = ecs.describe_services(
-        cluster=resource['ResourceARN'],
-        services=services
-    )
-    for service in response['services']:
-        del service['events']
-    services = response['services']
+    # Services can share target groups, each one is described once
+    target_groups = {}
+    for service in services:
+        if service.get('launchType') == 'EC2':
+            for lb in service['loadBalancers']:
+                target_groups.setdefault(lb['targetGroupArn'])
+    target_instances = get_target_instances(context.client('elbv2'), list(target_groups), workers)
 
     for service in services:
-        target_groups = []
         instances = []
-        if service['launchType'] == 'EC2':
+        if service.get('launchType') == 'EC2':
             for lb in service['loadBalancers']:
-                target_groups.append(lb['targetGroupArn'])
-
-        elb = boto3.client('elbv2', config=config)
-        for target_group in target_groups:
-            response = elb.describe_target_health(
-                TargetGroupArn=target_group
-            )
-            targets = response['TargetHealthDescriptions']
-
-            for target in targets:
-                instances.append(target['Target']['Id'])
-
+                instances.extend(target_instances[lb['targetGroupArn']])
         service['instances'] = instances
     resource['services'] = services
 
     return resource
 
 
-def natgw_decorator(resource, config):
+@decorates('ec2', 'natgateway')
+def natgw_decorator(resource, context, arn):
     print(f'This resource is NAT-gw {resource["ResourceARN"]}')
     return resource
 
 
-def network_firewall_decorator(resource, config):
+def get_firewall_vpc_endpoints(context):
+    """Firewall endpoints are Gateway Load Balancer endpoints, all of them are listed once per region."""
+    return paginate_index(context.client('ec2'), 'describe_vpc_endpoints', 'VpcEndpoints', 'VpcEndpointId',
+                          Filters=[{'Name': 'vpc-endpoint-type', 'Values': ['GatewayLoadBalancer']}])
+
+
+@decorates('network-firewall', 'firewall')
+def network_firewall_decorator(resource, context, arn):
     print(f'This resource is a Network Firewall')
-    nfw_client = boto3.client('network-firewall', config=config)
+    nfw_client = context.client('network-firewall')
     response = nfw_client.describe_firewall(
         FirewallArn=resource['ResourceARN']
     )
@@ -625,17 +1511,21 @@ def network_firewall_decorator(resource, config):
     resource['FirewallStatus'] = response['FirewallStatus']
 
     if 'SyncStates' in resource['FirewallStatus']:
+        vpc_endpoints = context.index('ec2:firewall-vpc-endpoints', lambda: get_firewall_vpc_endpoints(context))
         for az in resource['FirewallStatus']['SyncStates'].items():
             print(f"Checking {az[1]['Attachment']['EndpointId']}")
             vpc_endpoint_id = az[1]['Attachment']['EndpointId']
-            ec2_client = boto3.client('ec2', config=config)
-            response = ec2_client.describe_vpc_endpoints(
-                VpcEndpointIds=[
-                    vpc_endpoint_id,
-                ]
-            )
-            az[1]['Attachment']['ServiceName'] = response['VpcEndpoints'][0]['ServiceName']
-            for tag in response['VpcEndpoints'][0]['Tags']:
+            if vpc_endpoint_id not in vpc_endpoints:
+                ec2_client = context.client('ec2')
+                response = ec2_client.describe_vpc_endpoints(
+                    VpcEndpointIds=[
+                        vpc_endpoint_id,
+                    ]
+                )
+                vpc_endpoints[vpc_endpoint_id] = response['VpcEndpoints'][0]
+            vpc_endpoint = vpc_endpoints[vpc_endpoint_id]
+            az[1]['Attachment']['ServiceName'] = vpc_endpoint['ServiceName']
+            for tag in vpc_endpoint.get('Tags', []):
                 if tag['Key'] == 'Name':
                     az[1]['Attachment']['vpceEndpointName'] = tag['Value']
 
@@ -645,32 +1535,23 @@ def network_firewall_decorator(resource, config):
 
     resource['LoggingConfiguration'] = response['LoggingConfiguration']
 
-    cw_client = boto3.client('cloudwatch', config=config)
-    response = cw_client.list_metrics(
-        Namespace='AWS/NetworkFirewall',
-        Dimensions=[
-            {
-                'Name': 'FirewallName',
-                'Value': resource['ResourceARN'].split('/')[1:][0]
-            }
-        ]
-
-    )
-    resource['Metrics'] = response['Metrics']
+    resource['Metrics'] = context.metric_index.get(context, 'AWS/NetworkFirewall', 'FirewallName',
+                                                   arn.resource_id)
 
     return resource
 
 
-def rds_decorator(resource, config):
+def rds_decorator(resource, context, arn):
     print(f'This resource is RDS {resource["ResourceARN"]}')
     return resource
 
 
-def s3_decorator(resource, config):
-    bucket_name = resource['ResourceARN'].split(':')[len(resource['ResourceARN'].split(':'))-1]
+@decorates('s3')
+def s3_decorator(resource, context, arn):
+    bucket_name = arn.resource_id
     resource['BucketName'] = bucket_name
     print(f'This resource {bucket_name} is S3 bucket')
-    s3client = boto3.client('s3', config=config)
+    s3client = context.client('s3')
     try:
         encryption_request = s3client.get_bucket_encryption(
             Bucket=bucket_name
@@ -697,24 +1578,26 @@ def s3_decorator(resource, config):
     return resource
 
 
-def sqs_decorator(resource, config):
+@decorates('sqs')
+def sqs_decorator(resource, context, arn):
     print(f'This resource is SQS {resource["ResourceARN"]}')
-    queue_name = resource['ResourceARN'].split(':')[len(resource['ResourceARN'].split(':'))-1]
-    sqs = boto3.client('sqs', config=config)
-    response = sqs.get_queue_url(
+    queue_name = arn.resource_id
+    sqs = context.client('sqs')
+    queue_url = prefetched(context, arn) or sqs.get_queue_url(
         QueueName=queue_name
-    )
+    )['QueueUrl']
     response = sqs.get_queue_attributes(
         AttributeNames=['All'],
-        QueueUrl=response['QueueUrl']
+        QueueUrl=queue_url
     )
     resource['Attributes'] = response['Attributes']
     return resource
 
 
-def sns_decorator(resource, config):
+@decorates('sns')
+def sns_decorator(resource, context, arn):
     print(f'This resource is SNS {resource["ResourceARN"]}')
-#     sns = boto3.client('sns', config=config)
+#     sns = context.client('sns')
 #     response = sns.get_topic_attributes(
 #         TopicArn=resource['ResourceARN']
 #     )
@@ -724,22 +1607,24 @@ def sns_decorator(resource, config):
     return resource
 
 
-def tgw_decorator(resource, config):
+@decorates('ec2', 'transit-gateway')
+def tgw_decorator(resource, context, arn):
     print(f'This resource is TGW {resource["ResourceARN"]}')
-    tgwid = resource['ResourceARN'].split('/')[len(resource['ResourceARN'].split('/'))-1]
-    tgw = boto3.client('ec2', config=config)
-
-    attachments = []
-    attachment_paginator = tgw.get_paginator('describe_transit_gateway_attachments')
-    attachment_iterator = attachment_paginator.paginate(Filters=[{
-            'Name': 'transit-gateway-id',
-            'Values': [
-                tgwid
-            ]
-        }])
+    tgwid = arn.resource_id
+    attachments = children(context, resource['ResourceARN'])
+    if attachments is None:
+        tgw = context.client('ec2')
+        attachments = []
+        attachment_paginator = tgw.get_paginator('describe_transit_gateway_attachments')
+        attachment_iterator = attachment_paginator.paginate(Filters=[{
+                'Name': 'transit-gateway-id',
+                'Values': [
+                    tgwid
+                ]
+            }])
 
-    for attachment_page in attachment_iterator:
-        attachments.extend(attachment_page['TransitGatewayAttachments'])
+        for attachment_page in attachment_iterator:
+            attachments.extend(attachment_page['TransitGatewayAttachments'])
 
     resource['attachments'] = attachments
     return resource
@@ -760,7 +1645,587 @@ def get_config(region):
     )
 
 
-def handler():
+def get_collector_settings(main_config):
+    """Collector tuning lives in the optional 'Collector' section of lib/config.json.
+    Missing keys fall back to COLLECTOR_DEFAULTS, nested objects are merged with their defaults.
+    """
+    collector_settings = dict(COLLECTOR_DEFAULTS)
+    try:
+        if main_config['Collector']:
+            for key, value in main_config['Collector'].items():
+                if isinstance(value, dict) and isinstance(collector_settings.get(key), dict):
+                    collector_settings[key] = collector_settings[key] | value
+                else:
+                    collector_settings[key] = value
+    except KeyError:
+        print('No collector settings configured using defaults')
+    return collector_settings
+
+
+def paginate_index(client, operation, result_key, id_key, **args):
+    """Pages through a list/describe operation and indexes the items by id_key."""
+    index = {}
+    for page in client.get_paginator(operation).paginate(**args):
+        for item in page[result_key]:
+            index[item[id_key]] = item
+    return index
+
+
+@prefetches('lambda', 'function')
+def prefetch_lambda_functions(context):
+    return paginate_index(context.client('lambda'), 'list_functions', 'Functions', 'FunctionName')
+
+
+@prefetches('rds', 'cluster')
+def prefetch_db_clusters(context):
+    return paginate_index(context.client('rds'), 'describe_db_clusters', 'DBClusters', 'DBClusterIdentifier')
+
+
+@prefetches('elasticfilesystem', 'file-system')
+def prefetch_file_systems(context):
+    return paginate_index(context.client('efs'), 'describe_file_systems', 'FileSystems', 'FileSystemId')
+
+
+@prefetches('elasticache', 'cluster')
+def prefetch_cache_clusters(context):
+    return paginate_index(context.client('elasticache'), 'describe_cache_clusters', 'CacheClusters', 'CacheClusterId')
+
+
+@prefetches('apigateway', 'restapis')
+def prefetch_rest_apis(context):
+    return paginate_index(context.client('apigateway'), 'get_rest_apis', 'items', 'id')
+
+
+@prefetches('apigateway', 'apis')
+def prefetch_http_apis(context):
+    return paginate_index(context.client('apigatewayv2'), 'get_apis', 'Items', 'ApiId')
+
+
+@prefetches('appsync', 'apis')
+def prefetch_graphql_apis(context):
+    return paginate_index(context.client('appsync'), 'list_graphql_apis', 'graphqlApis', 'apiId')
+
+
+@prefetches('sqs')
+def prefetch_queue_urls(context):
+    queue_urls = {}
+    # SQS only returns NextToken when MaxResults is set, without a page size the listing stops after 1000 queues
+    for page in context.client('sqs').get_paginator('list_queues').paginate(PaginationConfig={'PageSize': 1000}):
+        for queue_url in page.get('QueueUrls', []):
+            queue_urls[queue_url.split('/')[-1]] = queue_url
+    return queue_urls
+
+
+@fans_in('elasticloadbalancing', 'loadbalancer/app')
+@fans_in('elasticloadbalancing', 'loadbalancer/net')
+def fan_in_target_groups(context, load_balancer_arns):
+    """Lists the target groups of the region once and hands them to their load balancers."""
+    target_groups = {load_balancer_arn: [] for load_balancer_arn in load_balancer_arns}
+    for page in context.client('elbv2').get_paginator('describe_target_groups').paginate():
+        for target_group in page['TargetGroups']:
+            for load_balancer_arn in target_group['LoadBalancerArns']:
+                if load_balancer_arn in target_groups:
+                    target_groups[load_balancer_arn].append(target_group)
+    return target_groups
+
+
+@fans_in('ec2', 'transit-gateway')
+def fan_in_tgw_attachments(context, tgw_arns):
+    """Fetches the attachments of all transit gateways with multi-value filters (max 200 values per filter)."""
+    tgw_arns = {parse_arn(tgw_arn).resource_id: tgw_arn for tgw_arn in tgw_arns}
+    attachments = {tgw_arn: [] for tgw_arn in tgw_arns.values()}
+    ec2 = context.client('ec2')
+    for id_chunk in chunks(list(tgw_arns), 200):
+        for page in ec2.get_paginator('describe_transit_gateway_attachments').paginate(
+                Filters=[{'Name': 'transit-gateway-id', 'Values': id_chunk}]):
+            for attachment in page['TransitGatewayAttachments']:
+                attachments[tgw_arns[attachment['TransitGatewayId']]].append(attachment)
+    return attachments
+
+
+def fan_in(resources, context):
+    """Gathers the parents of every @fans_in type in the region and fetches their children in bulk.
+    Decorators read them with children() and fetch parents missing from the result themselves.
+    """
+    parents = {}
+    for resource in resources:
+        arn = parse_arn(resource['ResourceARN'])
+        if (arn.service, arn.resource_type) in FAN_INS:
+            parents.setdefault(FAN_INS[(arn.service, arn.resource_type)], []).append(resource['ResourceARN'])
+
+    for fetch, parent_arns in parents.items():
+        try:
+            fetched = fetch(context, parent_arns)
+        except ClientError as error:
+            print(f'Fetching children in bulk in {context.region} failed, fetching one by one: {error}')
+            continue
+        for parent_arn in parent_arns:
+            arn = parse_arn(parent_arn)
+            context.children.setdefault((arn.service, arn.resource_type), {})[parent_arn] = fetched[parent_arn]
+
+
+def prefetch_bulk(resources, context):
+    """Lists a resource type once for the whole region when the region has more than bulkPrefetchThreshold of them.
+    Decorators read the results with prefetched() and describe resources missing from the index themselves.
+    """
+    counts = {}
+    for resource in resources:
+        arn = parse_arn(resource['ResourceARN'])
+        if (arn.service, arn.resource_type) in PREFETCHERS:
+            counts[(arn.service, arn.resource_type)] = counts.get((arn.service, arn.resource_type), 0) + 1
+    threshold = int(context.collector_settings['bulkPrefetchThreshold'])
+    resource_types = [resource_type for resource_type, count in counts.items() if count > threshold]
+    if not resource_types:
+        return
+
+    def fetch(resource_type):
+        try:
+            return resource_type, PREFETCHERS[resource_type](context)
+        except ClientError as error:
+            print(f'Bulk prefetch of {resource_type} in {context.region} failed, describing one by one: {error}')
+            return resource_type, {}
+
+    workers = max(1, int(context.collector_settings['enrichmentConcurrency']))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for resource_type, index in executor.map(fetch, resource_types):
+            print(f'{context.region}: prefetched {len(index)} {":".join(filter(None, resource_type))}')
+            context.prefetched[resource_type] = index
+
+
+def prefetch_region(resources, context):
+    """Runs the region wide bulk enrichment stages before resources are decorated one by one."""
+    prefetch_bulk(resources, context)
+    fan_in(resources, context)
+    arns = [parse_arn(resource['ResourceARN']) for resource in resources]
+    instance_ids = [arn.resource_id for arn in arns if (arn.service, arn.resource_type) == ('ec2', 'instance')]
+    if instance_ids:
+        prefetch_ec2_instances(instance_ids, context)
+    if any((arn.service, arn.resource_type) == ('directconnect', 'dxvif') for arn in arns):
+        prefetch_direct_connect(context)
+
+
+def decorate_resources(resources, context, collector_settings):
+    """Runs router() for all resources of a region in a bounded thread pool.
+    Each AWS service has its own concurrency cap (serviceConcurrency) so that chatty services
+    like Lambda can go wide while throttling-prone ones like Direct Connect stay serial.
+    The cap is enforced when work is submitted: resources of a service at its cap wait in the queue of that service
+    and the pool threads go to other services, instead of blocking a thread each.
+    Yields the result of router() for every resource, in the same order as resources.
+    """
+    workers = max(1, int(collector_settings['decoratorConcurrency']))
+    services = [parse_arn(resource['ResourceARN']).service for resource in resources]
+    limits = {service: max(1, int(collector_settings['serviceConcurrency'].get(
+        service, collector_settings['defaultServiceConcurrency']))) for service in set(services)}
+    queues = {service: deque() for service in limits}
+    running = dict.fromkeys(limits, 0)
+    finished = {}
+    condition = threading.Condition()  # Reentrant, done callbacks of futures that finished already run inline
+
+    def dispatch(service):
+        while running[service] < limits[service] and queues[service]:
+            index = queues[service].popleft()
+            running[service] += 1
+            future = executor.submit(router, resources[index], context)
+            future.add_done_callback(partial(done, service, index))
+
+    def done(service, index, future):
+        with condition:
+            finished[index] = future
+            running[service] -= 1
+            dispatch(service)
+            condition.notify_all()
+
+    # Resources are queued at most window ahead of the one handed out next, which keeps memory flat
+    window = workers * 64
+    queued = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for index in range(len(resources)):
+                with condition:
+                    while queued < len(resources) and queued - index < window:
+                        queues[services[queued]].append(queued)
+                        dispatch(services[queued])
+                        queued += 1
+                    condition.wait_for(lambda: index in finished)
+                    future = finished.pop(index)
+                yield future.result()
+        finally:
+            with condition:
+                for queue in queues.values():
+                    queue.clear()
+
+
+def tag_fingerprint(resource):
+    return json.dumps(sorted([tag['Key'], tag['Value']] for tag in resource.get('Tags', [])))
+
+
+def incremental_ttl(resource, collector_settings):
+    ttls = collector_settings['incrementalTtlMinutes']
+    service = parse_arn(resource['ResourceARN']).service
+    return timedelta(minutes=ttls.get(service, ttls['default']))
+
+
+def select_reusable(resources, previous, collector_settings, now):
+    """Splits tagging results into previously decorated resources that can be reused and resources to decorate.
+    A resource is reused when it was in the previous run with the same tags and its decoration is younger than
+    the TTL of its service. Direct Connect VIFs are always refreshed as they are merged into their connection.
+    """
+    reused = {}
+    pending = []
+    for resource in resources:
+        arn = resource['ResourceARN']
+        if arn in previous and ':directconnect:' not in arn:
+            previous_resource, previous_state = previous[arn]
+            if previous_state['Tags'] == tag_fingerprint(resource) and \
+                    now - datetime.fromisoformat(previous_state['DecoratedAt']) < incremental_ttl(resource, collector_settings):
+                reused[arn] = previous_resource
+                continue
+        pending.append(resource)
+    return reused, pending
+
+
+def load_previous_run(output_files, collector_settings):
+    """Previous resources of the output_files and their decoration state indexed by ARN, empty if there is nothing
+    to reuse.
+    """
+    if not collector_settings['incremental']:
+        return {}
+    if collector_settings['cassetteMode'] != 'off':
+        print('Cassette runs decorate all resources, incremental reuse is off')
+        return {}
+    try:
+        previous_resources = []
+        for output_file in output_files:
+            previous_resources += read_resources(output_file, collector_settings['outputFormat'],
+                                                 collector_settings['outputGzip'])
+        with open(collector_settings['incrementalStateFile'], "r", encoding="utf-8") as f:
+            previous_state = json.load(f)
+    except FileNotFoundError:
+        print('No previous run found, decorating all resources')
+        return {}
+    except (OSError, ValueError) as e:
+        print(f'Could not read previous run ({e}), decorating all resources')
+        return {}
+
+    previous = {}
+    for resource in previous_resources:
+        if resource['ResourceARN'] in previous_state:
+            previous[resource['ResourceARN']] = (resource, previous_state[resource['ResourceARN']])
+    print(f'Loaded {len(previous)} resources from previous run')
+    return previous
+
+
+def summarize_types(resources):
+    """Resource counts per type, e.g. '3 ec2:instance, 1 sqs, 2 unsupported'."""
+    counts = {}
+    unsupported = 0
+    for resource in resources:
+        arn = parse_arn(resource['ResourceARN'])
+        if find_decorator(arn):
+            counts[type_name(arn)] = counts.get(type_name(arn), 0) + 1
+        else:
+            unsupported += 1
+    return ', '.join([f'{count} {name}' for name, count in sorted(counts.items())] + [f'{unsupported} unsupported'])
+
+
+def progress_file(spool_file):
+    return os.path.splitext(spool_file)[0] + '.progress.ndjson'
+
+
+def load_progress(spool_file):
+    """Resources an interrupted run already spooled to spool_file with their state, indexed by ARN like
+    load_previous_run(). The progress file has an [ARN, state] line for every spooled resource.
+    """
+    progress = {}
+    try:
+        with open(spool_file, "r", encoding="utf-8") as spool, \
+                open(progress_file(spool_file), "r", encoding="utf-8") as states:
+            for line, state_line in zip(spool, states):
+                try:
+                    arn, state = json.loads(state_line)
+                    progress[arn] = (json.loads(line), state)
+                except ValueError:  # Last line of a killed run
+                    break
+    except FileNotFoundError:
+        return {}
+    if progress:
+        print(f'Resuming {len(progress)} resources from {spool_file}')
+    return progress
+
+
+def decorate_and_spool(resources, context, collector_settings, previous, spool_file):
+    """Decorates resources (reusing previous decorations where allowed) and spools them to spool_file in order,
+    already serialised for the output format.
+    Resources spooled by an interrupted run are reused like those of a previous run.
+    """
+    now = datetime.now(timezone.utc)
+    output_format = collector_settings['outputFormat']
+    previous = previous | load_progress(spool_file)
+    reused, pending = select_reusable(resources, previous, collector_settings, now)
+    prefetch_region(pending, context)
+    decorated = decorate_resources(pending, context, collector_settings)
+
+    state = {}
+    refreshed = 0
+    with ResourceWriter(spool_file, 'ndjson') as spool, ResourceWriter(progress_file(spool_file), 'ndjson') as progress:
+        for resource in resources:
+            arn = resource['ResourceARN']
+            if arn in reused:
+                reused_resource = project_resource(context.annotate(reused[arn]), collector_settings)
+                spool.write_line(ResourceWriter.line(reused_resource, output_format))
+                state[arn] = previous[arn][1]
+                progress.write([arn, state[arn]])
+                continue
+
+            decorated_resource = next(decorated)
+            if decorated_resource:
+                print(f'Adding {decorated_resource["ResourceARN"]}')
+                decorated_resource = project_resource(context.annotate(decorated_resource), collector_settings)
+                spool.write_line(ResourceWriter.line(decorated_resource, output_format))
+                state[arn] = {'Tags': tag_fingerprint(resource), 'DecoratedAt': now.isoformat()}
+                progress.write([arn, state[arn]])
+                refreshed += 1
+    print(f'{context.region}: reused {len(reused)} and refreshed {refreshed} resources')
+    direct_connects, direct_connect_vifs = group_direct_connects(pending, context)
+    for direct_connect in direct_connects + direct_connect_vifs:
+        context.annotate(direct_connect)
+    write_replication_groups(context)
+
+    return {'SpoolFile': spool_file,
+            'State': state,
+            'Reused': len(reused),
+            'Refreshed': refreshed,
+            'DirectConnects': direct_connects,
+            'DirectConnectVifs': direct_connect_vifs,
+            'Failures': context.failures}
+
+
+CollectionUnit = namedtuple('CollectionUnit', ['name', 'account', 'region', 'plan', 'role_arn'])
+
+
+def get_accounts(collector_settings):
+    """Accounts of multi-account mode, Collector.accounts followed by the active accounts in organizationalUnit
+    and its child OUs. Empty in the default single account mode.
+    """
+    accounts = list(collector_settings['accounts'])
+    if collector_settings['organizationalUnit']:
+        organizations = client_pool.get('organizations', get_config(GLOBAL_REGION))
+        parents = [collector_settings['organizationalUnit']]
+        while parents:
+            parent = parents.pop(0)
+            for page in organizations.get_paginator('list_accounts_for_parent').paginate(ParentId=parent):
+                accounts += [account['Id'] for account in page['Accounts']
+                             if account['Status'] == 'ACTIVE' and account['Id'] not in accounts]
+            for page in organizations.get_paginator('list_organizational_units_for_parent').paginate(ParentId=parent):
+                parents += [unit['Id'] for unit in page['OrganizationalUnits']]
+        print(f'Added the active accounts of {collector_settings["organizationalUnit"]}, '
+              f'collecting {len(accounts)} accounts')
+    return accounts
+
+
+def get_resource_files(output_file, accounts):
+    """Resource file per account, keyed by account ID, or the single output_file keyed by None without accounts.
+    A dashboard stack shows the metrics of the account it is deployed in, so each account gets its own file, with the
+    account ID added to the name: resources.json becomes resources-123456789012.json.
+    """
+    if not accounts:
+        return {None: output_file}
+    directory, name = os.path.split(output_file)
+    stem, dot, extension = name.partition('.')
+    return {account: os.path.join(directory, f'{stem}-{account}{dot}{extension}') for account in accounts}
+
+
+def get_collection_units(regions, accounts, collector_settings):
+    """One CollectionUnit per region, or per account and region in multi-account mode.
+    GLOBAL_REGION is always collected, if it is not configured only for global services (plan 'global').
+    Other accounts are collected through assumeRoleName, the account of the run uses its own credentials.
+    """
+    region_plans = {region: 'full' for region in regions}
+    if GLOBAL_REGION not in region_plans:
+        region_plans[GLOBAL_REGION] = 'global'
+        print(f'Added {GLOBAL_REGION} region for global services')
+    if not accounts:
+        return [CollectionUnit(region, None, region, plan, None) for region, plan in region_plans.items()]
+
+    own_account = client_pool.get('sts', get_config(GLOBAL_REGION)).get_caller_identity()['Account']
+    units = []
+    for account in accounts:
+        for region, plan in region_plans.items():
+            role_name = collector_settings['assumeRoleName'].format(region=region)
+            role_arn = None if account == own_account else f'arn:aws:iam::{account}:role/{role_name}'
+            units.append(CollectionUnit(f'{account}-{region}', account, region, plan, role_arn))
+    print(f'Collecting {len(accounts)} accounts in {len(region_plans)} regions')
+    return units
+
+
+def global_unit_name(unit):
+    return f'{unit.account}-global' if unit.account else 'global'
+
+
+def collect_region(unit, tag_name, tag_values, collector_settings, cached_namespaces=None, previous=None):
+    """Collects and decorates all tagged resources of a single region (of an account in multi-account mode).
+    Runs as an independent worker, all state is kept in the region's own RegionContext.
+    A 'global' plan only fetches GLOBAL_RESOURCE_TYPES, for a region that is collected only for global services.
+    Global resources are not decorated here, they are returned under GlobalResources for collect_global().
+    """
+    start = time.perf_counter()
+    context = RegionContext(unit.region, collector_settings, unit.account, unit.role_arn)
+    if unit.plan == 'global':
+        resources = get_resources(tag_name, tag_values, context, collector_settings, global_only=True)
+        namespaces, namespace_cache = [], cached_namespaces
+    else:
+        resources = get_resources(tag_name, tag_values, context, collector_settings)
+        namespaces, namespace_cache = cw_custom_namespace_retriever(context, collector_settings, cached_namespaces)
+
+    print(f'{unit.name} ({unit.plan}): {summarize_types(resources)}')
+    global_resources = [resource for resource in resources if not parse_arn(resource['ResourceARN']).region]
+    resources = [resource for resource in resources if parse_arn(resource['ResourceARN']).region]
+
+    spool_file = os.path.join(collector_settings['workDirectory'], f'{unit.name}.ndjson')
+    region_result = decorate_and_spool(resources, context, collector_settings, previous or {}, spool_file)
+    region_result.update({'Unit': unit.name,
+                          'Account': unit.account,
+                          'Region': unit.region,
+                          'Plan': unit.plan,
+                          'Namespaces': namespaces,
+                          'NamespaceCache': namespace_cache,
+                          'GlobalResources': global_resources,
+                          'Seconds': time.perf_counter() - start})
+    write_checkpoint(region_result, collector_settings)
+    if collector_settings['executor'] == 'process':
+        region_result['Instrumentation'] = instrumentation.drain()
+        region_result['Cassette'] = cassette.drain()
+    return region_result
+
+
+def collect_global(unit, region_results, collector_settings, previous):
+    """Decorates the global resources (no region in the ARN) returned by any region of the account of unit, the
+    GLOBAL_REGION unit of the account, once per run and keyed by ARN.
+    The first region in region order that returned a resource wins, they are decorated from GLOBAL_REGION.
+    """
+    resources = {}
+    for region_result in region_results:
+        if region_result['Account'] == unit.account:
+            for resource in region_result['GlobalResources']:
+                resources.setdefault(resource['ResourceARN'], resource)
+
+    context = RegionContext(GLOBAL_REGION, collector_settings, unit.account, unit.role_arn)
+    spool_file = os.path.join(collector_settings['workDirectory'], f'{global_unit_name(unit)}.ndjson')
+    start = time.perf_counter()
+    previous = {arn: entry for arn, entry in previous.items()
+                if not parse_arn(arn).region and entry[0].get('Account') == unit.account}
+    global_result = decorate_and_spool(list(resources.values()), context, collector_settings, previous, spool_file)
+    global_result.update({'Unit': global_unit_name(unit),
+                          'Account': unit.account,
+                          'Region': 'global',
+                          'Plan': 'global',
+                          'Namespaces': [],
+                          'NamespaceCache': None,
+                          'GlobalResources': [],
+                          'Seconds': time.perf_counter() - start})
+    write_checkpoint(global_result, collector_settings)
+    return global_result
+
+
+def checkpoint_file(collector_settings, unit_name):
+    return os.path.join(collector_settings['workDirectory'], f'{unit_name}.checkpoint.json')
+
+
+def write_checkpoint(region_result, collector_settings):
+    """Marks a region as done, a resumed run reuses its result and spool file instead of collecting it again."""
+    path = checkpoint_file(collector_settings, region_result['Unit'])
+    with open(path + '.tmp', "w", encoding="utf-8") as checkpoint:
+        checkpoint.write(dumps({key: value for key, value in region_result.items()
+                                if key not in ('Instrumentation', 'Cassette')}))
+    os.replace(path + '.tmp', path)
+
+
+def clear_work_directory(collector_settings):
+    work_directory = collector_settings['workDirectory']
+    for name in os.listdir(work_directory):
+        if name.endswith(('.ndjson', '.checkpoint.json', '.checkpoint.json.tmp')) or name == 'run.json':
+            os.remove(os.path.join(work_directory, name))
+
+
+def load_checkpoints(collector_settings, run, unit_names, resume):
+    """Region results of an interrupted run, keyed by unit name, when resuming a run with the same settings (run).
+    Otherwise the work directory is cleared and a new run is started.
+    """
+    run_file = os.path.join(collector_settings['workDirectory'], 'run.json')
+    checkpoints = {}
+    if resume:
+        try:
+            with open(run_file, "r", encoding="utf-8") as f:
+                resumable = json.load(f) == run
+        except FileNotFoundError:
+            resumable = False
+        if resumable:
+            for unit_name in unit_names:
+                try:
+                    with open(checkpoint_file(collector_settings, unit_name), "r", encoding="utf-8") as f:
+                        checkpoints[unit_name] = json.load(f)
+                except FileNotFoundError:
+                    pass
+            print(f'Resuming run, {len(checkpoints)} regions are already done')
+            return checkpoints
+        print('Nothing to resume for this configuration, starting a new run')
+
+    clear_work_directory(collector_settings)
+    with open(run_file, "w", encoding="utf-8") as f:
+        f.write(json.dumps(run))
+    return checkpoints
+
+
+def previous_in_unit(previous, unit):
+    return {arn: entry for arn, entry in previous.items()
+            if parse_arn(arn).region == unit.region and entry[0].get('Account') == unit.account}
+
+
+def collect_regions(units, tag_name, tag_values, collector_settings, namespace_cache, previous):
+    """Runs collect_region() for every CollectionUnit of units in a thread or process pool.
+    Results are returned in the same order as units.
+    """
+    workers = max(1, min(int(collector_settings['regionConcurrency']), len(units)))
+    if collector_settings['executor'] == 'process':
+        executor_class = ProcessPoolExecutor
+    else:
+        executor_class = ThreadPoolExecutor
+
+    print(f'Collecting {len(units)} regions with {workers} {collector_settings["executor"]} workers')
+    with executor_class(max_workers=workers, initializer=install_hooks, initargs=(collector_settings,)) as executor:
+        futures = [executor.submit(collect_region, unit, tag_name, tag_values, collector_settings,
+                                   namespace_cache.get(unit.name), previous_in_unit(previous, unit))
+                   for unit in units]
+        return [future.result() for future in futures]
+
+
+def write_run_report(collector_settings, started, region_results, resource_count):
+    """Machine readable summary of a run: where the time went, per region, decorator and API operation."""
+    for region_result in region_results:
+        if 'Instrumentation' in region_result:
+            instrumentation.merge(region_result['Instrumentation'])
+    report = {'StartedAt': started.isoformat(),
+              'WallSeconds': round((datetime.now(timezone.utc) - started).total_seconds(), 3),
+              'Executor': collector_settings['executor'],
+              'Resources': resource_count,
+              'Regions': [{'Account': region_result['Account'],
+                           'Region': region_result['Region'],
+                           'Plan': region_result['Plan'],
+                           'Seconds': round(region_result['Seconds'], 3),
+                           'Reused': region_result['Reused'],
+                           'Refreshed': region_result['Refreshed']} for region_result in region_results],
+              'Failures': [failure for region_result in region_results for failure in region_result['Failures']]}
+    report.update(instrumentation.report())
+    if collector_settings['executor'] != 'process':  # Worker processes keep their own pools
+        report['ClientPool'] = client_pool.stats()
+        report['RateScheduler'] = rate_scheduler.stats()
+    with open(collector_settings['runReportFile'], "w", encoding="utf-8") as rr:
+        rr.write(json.dumps(report, indent=4))
+    print(f'Wrote run report to {collector_settings["runReportFile"]}')
+
+
+def handler(setting_overrides=None, resume=False):
+    started = datetime.now(timezone.utc)
     tag_name = 'iem'
     tag_values = ['202202', '202102']
     regions = ['eu-west-1', 'eu-north-1']
@@ -803,25 +2268,66 @@ def handler():
     except:
         print('No custom namespaces configured')
 
-    decorated_resources = []
-    region_namespaces = {'RegionNamespaces': []}
-    if 'us-east-1' not in regions:
-        regions.append('us-east-1')
-        print('Added us-east-1 region for global services')
-
-    for region in regions:
-        config = get_config(region)
-        resources = get_resources(tag_name, tag_values, config)
-        region_namespace = {'Region': region, 'Namespaces' : cw_custom_namespace_retriever(config) }
-        region_namespaces['RegionNamespaces'].append(region_namespace)
-        for resource in resources:
-            decorated_resource = router(resource, config)
-            if decorated_resource:
-                print(f'Adding {decorated_resource["ResourceARN"]}')
-                decorated_resources.append(decorated_resource)
+    collector_settings = get_collector_settings(main_config) | (setting_overrides or {})
+    os.makedirs(collector_settings['workDirectory'], exist_ok=True)
+    install_hooks(collector_settings)
 
-    decorated_resources.extend(direct_connects)
-    decorated_resources.extend(direct_connect_vifs)
+    region_namespaces = {'RegionNamespaces': []}
+    accounts = get_accounts(collector_settings)
+    resource_files = get_resource_files(output_file, accounts)
+    units = get_collection_units(regions, accounts, collector_settings)
+    global_units = [unit for unit in units if unit.region == GLOBAL_REGION]
+
+    unit_names = [unit.name for unit in units]
+    run = {'ResourceFile': output_file, 'OutputFormat': collector_settings['outputFormat'], 'TagKey': tag_name,
+           'TagValues': tag_values, 'Units': unit_names}
+    checkpoints = load_checkpoints(collector_settings, run,
+                                   unit_names + [global_unit_name(unit) for unit in global_units], resume)
+    namespace_cache = load_namespace_cache(collector_settings)
+    previous = load_previous_run(resource_files.values(), collector_settings)
+    pending_units = [unit for unit in units if unit.name not in checkpoints]
+    try:
+        collected = collect_regions(pending_units, tag_name, tag_values, collector_settings, namespace_cache, previous)
+        collected = {unit.name: region_result for unit, region_result in zip(pending_units, collected)}
+        region_results = [checkpoints.get(unit.name) or collected[unit.name] for unit in units]
+        global_results = [checkpoints.get(global_unit_name(unit)) or
+                          collect_global(unit, region_results, collector_settings, previous) for unit in global_units]
+        region_results.extend(global_results)
+    except Exception:
+        print(f'Collection failed, finished regions are checkpointed in {collector_settings["workDirectory"]}. '
+              f'Run again with --resume to continue from there.')
+        raise
+    collector_state = {}
+
+    # Merging in the configured region order keeps the output identical regardless of which worker finished first
+    for region_result in region_results:
+        if region_result['Plan'] == 'full':
+            region_namespaces['RegionNamespaces'].append(
+                {'Region': region_result['Region'], 'Namespaces': region_result['Namespaces']} |
+                ({'Account': region_result['Account']} if region_result['Account'] else {}))
+        if region_result['NamespaceCache']:
+            namespace_cache[region_result['Unit']] = region_result['NamespaceCache']
+        collector_state.update(region_result['State'])
+
+    resource_count = 0
+    for account, resource_file in resource_files.items():
+        account_results = [region_result for region_result in region_results if region_result['Account'] == account]
+        with ResourceWriter(resource_file, collector_settings['outputFormat'],
+                            collector_settings['outputGzip']) as output:
+            for region_result in account_results:
+                with open(region_result['SpoolFile'], "r", encoding="utf-8") as spool:
+                    for line in spool:
+                        output.write_line(line.rstrip('\n'))
+
+            for region_result in account_results:
+                for direct_connect in region_result['DirectConnects']:
+                    output.write(direct_connect)
+
+            for region_result in account_results:
+                for direct_connect_vif in region_result['DirectConnectVifs']:
+                    output.write(direct_connect_vif)
+        print(f'Wrote {output.count} resources to {resource_file}')
+        resource_count += output.count
 
     try:
         with open(custom_namespace_file, "w", encoding="utf-8") as cn:
@@ -829,12 +2335,56 @@ def handler():
     finally:
         cn.close()
 
-    try:
-        with open(output_file, "w", encoding="utf-8") as n:
-            n.write(json.dumps(decorated_resources, indent=4, default=str))
-    finally:
-        n.close()
+    if collector_settings['cassetteMode'] != 'replay':  # Replayed responses say nothing about the account today
+        with open(collector_settings['namespaceCacheFile'], "w", encoding="utf-8") as nc:
+            nc.write(json.dumps(namespace_cache, indent=4))
+
+        with open(collector_settings['incrementalStateFile'], "w", encoding="utf-8") as cs:
+            cs.write(json.dumps(collector_state))
+
+    print(f'Reused {sum(region_result["Reused"] for region_result in region_results)} and refreshed '
+          f'{sum(region_result["Refreshed"] for region_result in region_results)} resources')
+    failures = [failure for region_result in region_results for failure in region_result['Failures']]
+    if failures:
+        print(f'Left out {len(failures)} resources that could not be decorated:')
+        for failure in failures:
+            print(f'  {failure["ResourceARN"]} ({failure["Decorator"]}): {failure["Error"]}')
+
+    if collector_settings['executor'] != 'process':  # Worker processes keep their own pools
+        print(f'Client pool: {client_pool.stats()}')
+        print(f'Rate scheduler: {rate_scheduler.stats()}')
+    if collector_settings['runReportFile']:
+        write_run_report(collector_settings, started, region_results, resource_count)
+    if collector_settings['cassetteMode'] == 'record':
+        for region_result in region_results:
+            cassette.merge(region_result.get('Cassette', []))
+        cassette.save()
+    elif collector_settings['cassetteMode'] == 'replay' and collector_settings['executor'] != 'process':
+        print(f'Cassette: {cassette.stats()}')
+    clear_work_directory(collector_settings)
 
 
 if __name__ == '__main__':
-    handler()
+    parser = argparse.ArgumentParser(description='Collects tagged resources for the dashboards.')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile the run with cProfile and write the stats to FILE (main process only)')
+    cassette_arguments = parser.add_mutually_exclusive_group()
+    cassette_arguments.add_argument('--record', metavar='FILE',
+                                    help='Record every API call and response of the run to the cassette FILE')
+    cassette_arguments.add_argument('--replay', metavar='FILE',
+                                    help='Serve every API call from the cassette FILE instead of AWS')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run from its checkpoints instead of starting over')
+    args = parser.parse_args()
+    overrides = {}
+    if args.record:
+        overrides = {'cassetteMode': 'record', 'cassetteFile': args.record}
+    elif args.replay:
+        overrides = {'cassetteMode': 'replay', 'cassetteFile': args.replay}
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(handler, overrides, args.resume)
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+    else:
+        handler(overrides, args.resume)
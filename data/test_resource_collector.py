@@ -0,0 +1,402 @@
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from botocore.config import Config
+from botocore.exceptions import EndpointConnectionError, NoCredentialsError
+
+import benchmark
+import resource_collector as rc
+
+ACCOUNT = '123456789012'
+
+# One real ARN per supported resource type and the decorator router() sends it to
+DECORATED_ARNS = [
+    ('arn:aws:apigateway:eu-west-1::/restapis/a1b2c3d4e5', 'apigw1_decorator'),
+    ('arn:aws:apigateway:eu-west-1::/apis/a1b2c3d4e5', 'apigw2_decorator'),
+    (f'arn:aws:appsync:eu-west-1:{ACCOUNT}:apis/abcdefghijklmnopqrstuvwxyz', 'appsync_decorator'),
+    (f'arn:aws:rds:eu-west-1:{ACCOUNT}:cluster:my-aurora', 'aurora_decorator'),
+    (f'arn:aws:autoscaling:eu-west-1:{ACCOUNT}:autoScalingGroup:1a2b3c4d-5e6f-7a8b-9c0d-1e2f3a4b5c6d:'
+     f'autoScalingGroupName/my-asg', 'autoscaling_decorator'),
+    (f'arn:aws:elasticbeanstalk:eu-west-1:{ACCOUNT}:environment/my-app/my-env', 'beanstalk_decorator'),
+    (f'arn:aws:cloudfront::{ACCOUNT}:distribution/E2QWRUHAPOMQZL', 'cloudfront_decorator'),
+    (f'arn:aws:mediapackage:eu-west-1:{ACCOUNT}:channels/6d2a5b7c8e9f', 'mediapackage_decorator'),
+    (f'arn:aws:medialive:eu-west-1:{ACCOUNT}:channel:1234567', 'medialive_decorator'),
+    (f'arn:aws:networkmonitor:eu-west-1:{ACCOUNT}:monitor/my-monitor', 'network_monitor_decorator'),
+    (f'arn:aws:ec2:eu-west-1:{ACCOUNT}:capacity-reservation/cr-0123456789abcdef0', 'odcr_decorator'),
+    (f'arn:aws:dynamodb:eu-west-1:{ACCOUNT}:table/my-table', 'dynamodb_decorator'),
+    (f'arn:aws:elasticfilesystem:eu-west-1:{ACCOUNT}:file-system/fs-0123456789abcdef0', 'efs_decorator'),
+    (f'arn:aws:ec2:eu-west-1:{ACCOUNT}:instance/i-0123456789abcdef0', 'ec2_decorator'),
+    (f'arn:aws:elasticache:eu-west-1:{ACCOUNT}:cluster:my-cache-001', 'elasticache_decorator'),
+    (f'arn:aws:lambda:eu-west-1:{ACCOUNT}:function:my-function', 'lambda_decorator'),
+    (f'arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT}:loadbalancer/my-classic-elb', 'elb1_decorator'),
+    (f'arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT}:loadbalancer/app/my-alb/50dc6c495c0c9188',
+     'elb2_decorator'),
+    (f'arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT}:loadbalancer/net/my-nlb/50dc6c495c0c9188',
+     'elb2_decorator'),
+    (f'arn:aws:ecs:eu-west-1:{ACCOUNT}:cluster/my-cluster', 'ecs_decorator'),
+    (f'arn:aws:ec2:eu-west-1:{ACCOUNT}:natgateway/nat-0123456789abcdef0', 'natgw_decorator'),
+    (f'arn:aws:network-firewall:eu-west-1:{ACCOUNT}:firewall/my-firewall', 'network_firewall_decorator'),
+    ('arn:aws:s3:::my-bucket', 's3_decorator'),
+    (f'arn:aws:sqs:eu-west-1:{ACCOUNT}:my-queue', 'sqs_decorator'),
+    (f'arn:aws:sns:eu-west-1:{ACCOUNT}:my-topic', 'sns_decorator'),
+    (f'arn:aws:ec2:eu-west-1:{ACCOUNT}:transit-gateway/tgw-0123456789abcdef0', 'tgw_decorator'),
+    (f'arn:aws:directconnect:eu-west-1:{ACCOUNT}:dxvif/dxvif-fgh1ijk2', 'direct_connect_handler'),
+]
+
+# One real ARN per bulk prefetched and fanned in resource type
+PREFETCHED_ARNS = [
+    'arn:aws:apigateway:eu-west-1::/restapis/a1b2c3d4e5',
+    'arn:aws:apigateway:eu-west-1::/apis/a1b2c3d4e5',
+    f'arn:aws:appsync:eu-west-1:{ACCOUNT}:apis/abcdefghijklmnopqrstuvwxyz',
+    f'arn:aws:elasticache:eu-west-1:{ACCOUNT}:cluster:my-cache-001',
+    f'arn:aws:elasticfilesystem:eu-west-1:{ACCOUNT}:file-system/fs-0123456789abcdef0',
+    f'arn:aws:lambda:eu-west-1:{ACCOUNT}:function:my-function',
+    f'arn:aws:rds:eu-west-1:{ACCOUNT}:cluster:my-aurora',
+    f'arn:aws:sqs:eu-west-1:{ACCOUNT}:my-queue',
+]
+FANNED_IN_ARNS = [
+    f'arn:aws:ec2:eu-west-1:{ACCOUNT}:transit-gateway/tgw-0123456789abcdef0',
+    f'arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT}:loadbalancer/app/my-alb/50dc6c495c0c9188',
+    f'arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT}:loadbalancer/net/my-nlb/50dc6c495c0c9188',
+]
+
+
+@pytest.mark.parametrize('arn, decorator', DECORATED_ARNS)
+def test_find_decorator(arn, decorator):
+    assert rc.find_decorator(rc.parse_arn(arn)).__name__ == decorator
+
+
+@pytest.mark.parametrize('arn', [
+    'arn:aws:apigateway:eu-west-1::/restapis/a1b2c3d4e5/stages/prod',
+    f'arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT}:targetgroup/my-targets/73e2d6bc24d8a067',
+    f'arn:aws:ec2:eu-west-1:{ACCOUNT}:volume/vol-0123456789abcdef0',
+])
+def test_unsupported_types_have_no_decorator(arn):
+    assert rc.find_decorator(rc.parse_arn(arn)) is None
+
+
+@pytest.mark.parametrize('arn, expected', [
+    ('arn:aws:apigateway:eu-west-1::/restapis/a1b2c3d4e5/stages/prod',
+     rc.Arn('aws', 'apigateway', 'eu-west-1', '', 'restapis/stages', 'prod')),
+    (f'arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT}:loadbalancer/app/my-alb/50dc6c495c0c9188',
+     rc.Arn('aws', 'elasticloadbalancing', 'eu-west-1', ACCOUNT, 'loadbalancer/app', '50dc6c495c0c9188')),
+    (f'arn:aws:elasticloadbalancing:eu-west-1:{ACCOUNT}:loadbalancer/my-classic-elb',
+     rc.Arn('aws', 'elasticloadbalancing', 'eu-west-1', ACCOUNT, 'loadbalancer', 'my-classic-elb')),
+    (f'arn:aws:rds:eu-west-1:{ACCOUNT}:cluster:my-aurora',
+     rc.Arn('aws', 'rds', 'eu-west-1', ACCOUNT, 'cluster', 'my-aurora')),
+    ('arn:aws:s3:::my-bucket', rc.Arn('aws', 's3', '', '', None, 'my-bucket')),
+    (f'arn:aws:sqs:eu-west-1:{ACCOUNT}:my-queue', rc.Arn('aws', 'sqs', 'eu-west-1', ACCOUNT, None, 'my-queue')),
+])
+def test_parse_arn(arn, expected):
+    assert rc.parse_arn(arn) == expected
+
+
+def test_every_decorator_has_a_test_arn():
+    assert {rc.find_decorator(rc.parse_arn(arn)) for arn, _ in DECORATED_ARNS} == set(rc.DECORATORS.values())
+
+
+def test_prefetchers_and_fan_ins_match_parsed_arns():
+    assert {(rc.parse_arn(arn).service, rc.parse_arn(arn).resource_type) for arn in PREFETCHED_ARNS} == \
+        set(rc.PREFETCHERS)
+    assert {(rc.parse_arn(arn).service, rc.parse_arn(arn).resource_type) for arn in FANNED_IN_ARNS} == \
+        set(rc.FAN_INS)
+
+
+def test_resource_type_filters():
+    assert rc.get_resource_type_filters(rc.COLLECTOR_DEFAULTS) == [
+        'apigateway', 'appsync', 'cloudfront:distribution', 'directconnect:dxvif', 'dynamodb:table',
+        'ec2:capacity-reservation', 'ec2:instance', 'ec2:natgateway', 'ec2:transit-gateway', 'ecs:cluster',
+        'elasticache', 'elasticbeanstalk', 'elasticfilesystem:file-system', 'elasticloadbalancing:loadbalancer',
+        'lambda:function', 'medialive:channel', 'mediapackage:channels', 'network-firewall:firewall',
+        'networkmonitor:monitor', 'rds:cluster', 's3', 'sns', 'sqs', 'wafv2']
+    assert rc.get_resource_type_filters(rc.COLLECTOR_DEFAULTS | {'resourceTypeFilter': False}) is None
+
+
+@pytest.mark.parametrize('arn, in_global_plan', [
+    (f'arn:aws:wafv2:us-east-1:{ACCOUNT}:global/webacl/my-cloudfront-acl/a1b2c3d4', True),
+    (f'arn:aws:wafv2:us-east-1:{ACCOUNT}:regional/webacl/my-alb-acl/a1b2c3d4', False),
+    (f'arn:aws:cloudfront::{ACCOUNT}:distribution/E2QWRUHAPOMQZL', True),
+    ('arn:aws:s3:::my-bucket', True),
+])
+def test_global_plan_routing(arn, in_global_plan):
+    parsed = rc.parse_arn(arn)
+    assert any(parsed.service == resource_type.split(':')[0] for resource_type in rc.GLOBAL_RESOURCE_TYPES)
+    assert rc.in_global_plan(parsed) == in_global_plan
+
+
+@pytest.fixture
+def hooked_client_pool(monkeypatch):
+    """The client pool with the collector's event hooks, as install_hooks() sets them up for a run."""
+    monkeypatch.setattr(rc, 'hooks_installed', None)
+    monkeypatch.setattr(rc, 'client_pool', rc.ClientPool())
+    monkeypatch.setattr(rc, 'instrumentation', rc.Instrumentation())
+    rc.install_hooks(rc.COLLECTOR_DEFAULTS)
+    return rc.client_pool
+
+
+def test_transport_errors_reach_the_caller(hooked_client_pool, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    config = rc.get_config('eu-west-1').merge(Config(retries={'max_attempts': 1}))
+    sqs = hooked_client_pool.get('sqs', config)
+
+    def unreachable(request, **kwargs):
+        raise EndpointConnectionError(endpoint_url=request.url)
+    sqs.meta.events.register('before-send', unreachable)
+
+    with pytest.raises(EndpointConnectionError):
+        sqs.list_queues()
+    calls = rc.instrumentation.report()['Calls']
+    assert [(call['Operation'], call['Count'], call['Errors']) for call in calls] == [('ListQueues', 1, 1)]
+
+
+def test_missing_credentials_reach_the_caller(hooked_client_pool, monkeypatch, tmp_path):
+    for variable in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_PROFILE'):
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setenv('AWS_SHARED_CREDENTIALS_FILE', str(tmp_path / 'credentials'))
+    monkeypatch.setenv('AWS_CONFIG_FILE', str(tmp_path / 'config'))
+    monkeypatch.setenv('AWS_EC2_METADATA_DISABLED', 'true')
+    sqs = hooked_client_pool.get('sqs', rc.get_config('eu-west-1'))
+
+    with pytest.raises(NoCredentialsError):
+        sqs.list_queues()
+
+
+def test_rate_scheduler_buckets_per_account():
+    scheduler = rc.RateScheduler()
+    scheduler.configure(rc.COLLECTOR_DEFAULTS)
+    own_account = scheduler.bucket('ec2', 'eu-west-1', 'default')
+    assert scheduler.bucket('ec2', 'eu-west-1', '210987654321') is not own_account
+    assert scheduler.bucket('ec2', 'eu-west-1', 'default') is own_account
+
+    scheduler.bucket('ec2', 'eu-west-1', '210987654321').throttled()
+    own_account.throttled()
+    assert set(scheduler.stats()) == {'ec2/eu-west-1', 'ec2/eu-west-1/210987654321'}
+
+
+def test_service_cap_leaves_threads_to_other_services(monkeypatch):
+    queues = [{'ResourceARN': f'arn:aws:sqs:eu-west-1:{ACCOUNT}:queue-{i}'} for i in range(3)]
+    topics = [{'ResourceARN': f'arn:aws:sns:eu-west-1:{ACCOUNT}:topic-{i}'} for i in range(3)]
+    topics_done = threading.Event()
+    decorated = []
+
+    def router(resource, context):
+        # The first queue holds its thread until every topic is done, which needs the other thread of the pool
+        if ':sqs:' in resource['ResourceARN'] and not decorated:
+            assert topics_done.wait(timeout=5)
+        decorated.append(resource['ResourceARN'])
+        if sum(':sns:' in arn for arn in decorated) == len(topics):
+            topics_done.set()
+        return resource
+    monkeypatch.setattr(rc, 'router', router)
+
+    settings = rc.COLLECTOR_DEFAULTS | {'decoratorConcurrency': 2, 'serviceConcurrency': {'sqs': 1}}
+    assert list(rc.decorate_resources(queues + topics, None, settings)) == queues + topics
+
+
+@pytest.mark.parametrize('output_format', ['json', 'compact', 'ndjson'])
+def test_resource_writer_layout(output_format, tmp_path):
+    resources = [{'ResourceARN': 'arn:aws:sqs:eu-west-1:123456789012:my-queue',
+                  'Tags': [{'Key': 'iem', 'Value': 'tab\tnew\nline é'}],
+                  'Attributes': {'Nested': [1, 2.5, None, True], 'Empty': {}}},
+                 {'ResourceARN': 'arn:aws:s3:::my-bucket', 'Tags': []}]
+    path = tmp_path / 'resources.json'
+    with rc.ResourceWriter(path, output_format) as output:
+        output.write(resources[0])
+        # Spooled lines are written as they are, and have to be valid JSON for resumed runs
+        line = rc.ResourceWriter.line(resources[1], output_format)
+        assert json.loads(line) == resources[1]
+        output.write_line(line)
+
+    assert rc.read_resources(path, output_format) == resources
+    if output_format == 'json':
+        assert path.read_text(encoding='utf-8') == json.dumps(resources, indent=4)
+
+
+@pytest.fixture
+def offline_run(tmp_path, monkeypatch):
+    """Runs handler() in tmp_path like benchmark.py does, with every call answered from a benchmark.SyntheticEstate.
+    Each run starts from fresh module state and returns the resources it wrote, of all accounts. Without an estate
+    nothing answers the calls, which is how a replay has to run.
+    """
+    (tmp_path / 'lib').mkdir()
+    (tmp_path / 'data').mkdir()
+    monkeypatch.chdir(tmp_path / 'data')
+
+    def run(collector=None, estate=None, regions=('eu-west-1',), resume=False):
+        config = {'ResourceFile': 'resources.json', 'CustomNamespaceFile': 'custom_namespaces.json',
+                  'TagKey': benchmark.TAG_KEY, 'TagValues': [benchmark.TAG_VALUE], 'Regions': list(regions),
+                  'Collector': {'rateScheduler': False} | (collector or {})}
+        (tmp_path / 'lib' / 'config.json').write_text(json.dumps(config), encoding='utf-8')
+        monkeypatch.setattr(rc, 'hooks_installed', None)
+        monkeypatch.setattr(rc, 'client_pool', rc.ClientPool())
+        monkeypatch.setattr(rc, 'instrumentation', rc.Instrumentation())
+        monkeypatch.setattr(rc, 'cassette', rc.Cassette())
+        monkeypatch.setattr(rc, 'rate_scheduler', rc.RateScheduler())
+        settings = rc.get_collector_settings(config)
+        rc.install_hooks(settings)
+        if estate:
+            benchmark.StandIn(estate, 0, 0, 0, 1, 0).install()
+        rc.handler(resume=resume)
+        resource_files = rc.get_resource_files(config['ResourceFile'], settings['accounts']).values()
+        return [resource for resource_file in resource_files
+                for resource in rc.read_resources(resource_file, settings['outputFormat'], settings['outputGzip'])]
+    return run
+
+
+def synthetic_estate(counts, regions=('eu-west-1',)):
+    return benchmark.SyntheticEstate(list(regions) + [rc.GLOBAL_REGION], counts)
+
+
+def test_replay_of_a_recording(offline_run, tmp_path):
+    collector = {'incremental': True, 'cassetteFile': 'cassette.ndjson.gz'}
+    recorded = offline_run(collector | {'cassetteMode': 'record'}, synthetic_estate({'sqs': 2, 'ecs': 1, 's3': 1}))
+    # The recording leaves a namespace cache and incremental state behind, the replay must not use them
+    assert (tmp_path / 'data' / 'namespace_cache.json').exists()
+    assert (tmp_path / 'data' / 'collector_state.json').exists()
+
+    replayed = offline_run(collector | {'cassetteMode': 'replay'})
+    assert rc.cassette.stats()['Misses'] == 0
+    assert replayed == recorded
+
+
+def test_global_plan_keeps_global_web_acls(offline_run):
+    estate = synthetic_estate({'sqs': 1})
+    global_acl = f'arn:aws:wafv2:{rc.GLOBAL_REGION}:{benchmark.ACCOUNT}:global/webacl/my-cloudfront-acl/a1b2c3d4'
+    regional_acl = f'arn:aws:wafv2:{rc.GLOBAL_REGION}:{benchmark.ACCOUNT}:regional/webacl/my-alb-acl/a1b2c3d4'
+    estate.tag(rc.GLOBAL_REGION, global_acl)
+    estate.tag(rc.GLOBAL_REGION, regional_acl)
+
+    arns = [resource['ResourceARN'] for resource in offline_run(estate=estate)]
+    assert global_acl in arns
+    assert regional_acl not in arns
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_one_resource_file_per_account(offline_run, tmp_path, executor):
+    estate = synthetic_estate({'sqs': 2, 's3': 1})
+    resources = offline_run({'accounts': [benchmark.ACCOUNT], 'executor': executor}, estate)
+
+    assert (tmp_path / 'data' / f'resources-{benchmark.ACCOUNT}.json').exists()
+    assert len(resources) == 3
+    assert {resource['Account'] for resource in resources} == {benchmark.ACCOUNT}
+    assert not (tmp_path / 'data' / 'resources.json').exists()
+    # Forked workers start without the calls of their parent, so the parent's are reported once
+    report = json.loads((tmp_path / 'data' / 'collector_report.json').read_text(encoding='utf-8'))
+    assert [call['Count'] for call in report['Calls'] if call['Operation'] == 'GetCallerIdentity'] == [1]
+
+
+def test_resource_files_per_account():
+    assert rc.get_resource_files('../data/resources.json', []) == {None: '../data/resources.json'}
+    assert rc.get_resource_files('../data/resources.json.gz', ['123456789012', '210987654321']) == {
+        '123456789012': '../data/resources-123456789012.json.gz',
+        '210987654321': '../data/resources-210987654321.json.gz'}
+
+
+def test_aurora_decorator(offline_run):
+    estate = synthetic_estate({'rds': 1})
+    cluster = next(iter(estate.db_clusters.values()))
+    cluster.update({'DBClusterInstanceClass': 'db.r6gd.xlarge', 'StorageType': 'aurora-iopt1', 'Iops': 3000,
+                    'PerformanceInsightsEnabled': True})
+
+    [resource] = offline_run(estate=estate)
+    assert resource['Engine'] == 'aurora-postgresql'
+    assert resource['DBClusterInstanceClass'] == 'db.r6gd.xlarge'
+    assert resource['StorageType'] == 'aurora-iopt1'
+    assert resource['Iops'] == 3000
+    assert resource['PerformanceInsightsEnabled'] is True
+
+
+def test_direct_connect_vifs_are_grouped_by_connection(offline_run):
+    estate = synthetic_estate({'dx': 4})
+    # A third VIF on the first connection and one whose connection does not exist
+    for vif_id, connection_id in (('dxvif-third', 'dxcon-00000000'), ('dxvif-orphan', 'dxcon-missing')):
+        estate.vifs[('eu-west-1', vif_id)] = {'virtualInterfaceId': vif_id, 'connectionId': connection_id,
+                                              'virtualInterfaceType': 'private'}
+        estate.tag('eu-west-1', f'arn:aws:directconnect:eu-west-1:{benchmark.ACCOUNT}:dxvif/{vif_id}')
+
+    resources = offline_run(estate=estate)
+    connections = {resource['connectionId']: [vif['vif']['virtualInterfaceId'] for vif in resource['VIFs']]
+                   for resource in resources if 'VIFs' in resource}
+    assert connections == {'dxcon-00000000': ['dxvif-00000000', 'dxvif-00000001', 'dxvif-third'],
+                           'dxcon-00000001': ['dxvif-00000002', 'dxvif-00000003']}
+    assert [resource['vif']['virtualInterfaceId'] for resource in resources if 'vif' in resource] == ['dxvif-orphan']
+
+
+def test_ecs_services_are_described_in_batches_of_ten(offline_run, tmp_path):
+    # The estate rejects DescribeServices with more than 10 services like ECS does
+    assert benchmark.ECS_SERVICES_PER_CLUSTER > 10
+    [resource] = offline_run(estate=synthetic_estate({'ecs': 1}))
+
+    assert [service['serviceArn'].split('/')[-1] for service in resource['services']] == \
+        [f'service-{i}' for i in range(benchmark.ECS_SERVICES_PER_CLUSTER)]
+    report = json.loads((tmp_path / 'data' / 'collector_report.json').read_text(encoding='utf-8'))
+    assert [call['Count'] for call in report['Calls'] if call['Operation'] == 'DescribeServices'] == [2]
+
+
+def test_incremental_reuse_expires_with_the_ttl():
+    arn = f'arn:aws:sqs:eu-west-1:{ACCOUNT}:my-queue'
+    resource = {'ResourceARN': arn, 'Tags': [{'Key': 'iem', 'Value': '202202'}]}
+    decorated = resource | {'QueueUrl': f'https://sqs.eu-west-1.amazonaws.com/{ACCOUNT}/my-queue'}
+    decorated_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    previous = {arn: (decorated, {'Tags': rc.tag_fingerprint(resource), 'DecoratedAt': decorated_at.isoformat()})}
+    settings = rc.COLLECTOR_DEFAULTS | {'incrementalTtlMinutes': {'default': 1440, 'sqs': 60}}
+
+    assert rc.select_reusable([resource], previous, settings, decorated_at + timedelta(minutes=59)) == \
+        ({arn: decorated}, [])
+    assert rc.select_reusable([resource], previous, settings, decorated_at + timedelta(minutes=61)) == \
+        ({}, [resource])
+    retagged = resource | {'Tags': [{'Key': 'iem', 'Value': '202102'}]}
+    assert rc.select_reusable([retagged], previous, settings, decorated_at) == ({}, [retagged])
+
+
+def test_incremental_run_evicts_untagged_resources(offline_run, tmp_path):
+    estate = synthetic_estate({'sqs': 3})
+    first = offline_run({'incremental': True}, estate)
+    untagged = estate.resources['eu-west-1'].pop()['ResourceARN']
+
+    second = offline_run({'incremental': True}, estate)
+    report = json.loads((tmp_path / 'data' / 'collector_report.json').read_text(encoding='utf-8'))
+    assert sum(region['Reused'] for region in report['Regions']) == 2
+    assert second == [resource for resource in first if resource['ResourceARN'] != untagged]
+    state = json.loads((tmp_path / 'data' / 'collector_state.json').read_text(encoding='utf-8'))
+    assert untagged not in state
+    assert set(state) == {resource['ResourceARN'] for resource in second}
+
+
+def test_error_budget():
+    context = rc.RegionContext('eu-west-1', rc.COLLECTOR_DEFAULTS | {'errorBudget': 2})
+    for i in range(2):
+        context.failed({'ResourceARN': f'arn:aws:sqs:eu-west-1:{ACCOUNT}:queue-{i}'}, 'sqs_decorator', KeyError(i))
+    with pytest.raises(rc.ErrorBudgetExceeded):
+        context.failed({'ResourceARN': f'arn:aws:sqs:eu-west-1:{ACCOUNT}:queue-2'}, 'sqs_decorator', KeyError(2))
+    assert len(context.failures) == 3
+
+
+def test_resume_after_the_error_budget_ran_out(offline_run, tmp_path, monkeypatch):
+    regions = ('eu-west-1', 'eu-north-1')
+    estate = synthetic_estate({'sqs': 3}, regions)
+    failing_arn = estate.resources['eu-north-1'][2]['ResourceARN']
+    sqs_decorator = rc.DECORATORS[('sqs', None)]
+
+    def flaky_sqs_decorator(resource, context, arn):
+        if resource['ResourceARN'] == failing_arn:
+            raise KeyError('QueueUrl')
+        return sqs_decorator(resource, context, arn)
+    monkeypatch.setitem(rc.DECORATORS, ('sqs', None), flaky_sqs_decorator)
+    with pytest.raises(rc.ErrorBudgetExceeded):
+        offline_run({'errorBudget': 0}, estate, regions)
+    # eu-west-1 and us-east-1 finished and are checkpointed, eu-north-1 spooled the queues before the failing one
+    work_directory = tmp_path / 'data' / rc.COLLECTOR_DEFAULTS['workDirectory']
+    assert len((work_directory / 'eu-north-1.progress.ndjson').read_text(encoding='utf-8').splitlines()) == 2
+
+    monkeypatch.setitem(rc.DECORATORS, ('sqs', None), sqs_decorator)
+    resources = offline_run({'errorBudget': 0}, estate, regions, resume=True)
+    assert [resource['ResourceARN'] for resource in resources] == \
+        [resource['ResourceARN'] for region in regions for resource in estate.resources[region]]
+    report = json.loads((tmp_path / 'data' / 'collector_report.json').read_text(encoding='utf-8'))
+    assert {call['Region'] for call in report['Calls']} == {'eu-north-1'}
+    assert [(region['Region'], region['Reused'], region['Refreshed']) for region in report['Regions']
+            if region['Region'] == 'eu-north-1'] == [('eu-north-1', 2, 1)]
@@ -2,19 +2,53 @@ import {Stack,StackProps} from 'aws-cdk-lib';
 import {Construct} from 'constructs'
 import {GraphFactory} from "./services/graphfactory";
 import {Dashboard} from "aws-cdk-lib/aws-cloudwatch";
+import * as fs from 'fs';
+import * as path from 'path';
+import * as zlib from 'zlib';
 
 const config = require('./config.json');
 
+/***
+ * resource_collector.py can write the resource file as indented JSON (default), compact JSON or NDJSON,
+ * optionally gzipped (Collector.outputFormat and Collector.outputGzip in config.json).
+ */
+function loadResources(resourceFile: string, collectorConfig: any) {
+  let content = fs.readFileSync(path.resolve(__dirname, resourceFile));
+  if ( collectorConfig?.outputGzip ){
+    content = zlib.gunzipSync(content);
+  }
+  const text = content.toString('utf-8');
+  if ( collectorConfig?.outputFormat === 'ndjson' ){
+    return text.split('\n').filter(line => line.trim().length > 0).map(line => JSON.parse(line));
+  }
+  return JSON.parse(text);
+}
+
+/***
+ * In multi-account mode (Collector.accounts or Collector.organizationalUnit) resource_collector.py writes one resource
+ * file per account, with the account ID added to the name of ResourceFile: resources.json becomes
+ * resources-123456789012.json. `cdk deploy -c account=123456789012` builds the dashboards of that account.
+ */
+function accountResourceFile(resourceFile: string, account: string) {
+  const name = path.basename(resourceFile);
+  const dot = name.indexOf('.');
+  const stem = dot < 0 ? name : name.substring(0, dot);
+  const extension = dot < 0 ? '' : name.substring(dot);
+  return path.join(path.dirname(resourceFile), `${stem}-${account}${extension}`);
+}
+
 export class IemDashboardStack extends Stack {
   constructor(scope: Construct, id: string, props?: StackProps) {
     super(scope, id, props);
 
+    const account = this.node.tryGetContext('account');
+    const resourceFile = account ? accountResourceFile(config.ResourceFile, account) : config.ResourceFile;
     let resources:any = [];
     try {
-      resources = require(config.ResourceFile);
-      console.log(`LOADED RESOURCE FILE ${config.ResourceFile}`);
+      resources = loadResources(resourceFile, config.Collector);
+      console.log(`LOADED RESOURCE FILE ${resourceFile}`);
     } catch {
-      console.log(`ERROR: ${config.ResourceFile} not found, run 'cd data; python resource_collector.py'`);
+      console.log(`ERROR: ${resourceFile} not found, run 'cd data; python resource_collector.py'`);
     }
 
     if ( ! config.MaxWidgetsPerDashboard ){